@@ -0,0 +1,112 @@
+"""Benchmark of the archive formats of a dataset streamed to the server: zip (WZipFile, stored or deflated) against
+tar (tarfile stream, uncompressed or gzipped).
+
+usage: python benchmarks/bench_archive_formats.py [dataset_directory]
+
+The files of dataset_directory (recursively) are archived as the data files of a dataset; without it, a synthetic
+dataset of 64 MiB of random data (like compressed images) and 64 MiB of text (like instrument logs and metadata) in
+files of 1 MiB to 8 MiB is used. The archives are written to a sink which only has write() and discards the data, as
+the request of a streamed archive, so that the figures measure the archive formats rather than the disk or the
+network.
+"""
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from wzipfile import WZipFile
+
+
+class StreamSink(object):
+    """Non-seekable sink, like the request of a streamed archive."""
+
+    def __init__(self):
+        self.length = 0
+
+    def write(self, data):
+        self.length += len(data)
+
+
+def write_zip(files, compress_type):
+    sink = StreamSink()
+    with WZipFile(sink, 'w', compress_type, allowZip64=True) as wzipfile:
+        for path, arcname in files:
+            with open(path, 'rb') as f:
+                wzipfile.writeobj(f, os.path.getsize(path), arcname, compress_type=compress_type)
+    return sink.length
+
+
+def write_tar(files, compression):
+    sink = StreamSink()
+    tar = tarfile.open(fileobj=sink, mode='w|' + compression)
+    for path, arcname in files:
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = os.path.getsize(path)
+        tarinfo.mode = 0o600
+        with open(path, 'rb') as f:
+            tar.addfile(tarinfo, f)
+    tar.close()
+    return sink.length
+
+
+def bench(func, files, arg, repeat=3):
+    best = None
+    length = 0
+    for _ in range(repeat):
+        start = time.time()
+        length = func(files, arg)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, length
+
+
+def synthetic_dataset(directory):
+    words = [os.urandom(random.randint(2, 8)).encode('hex') for _ in range(2048)]
+    for kind in ('random', 'text'):
+        total = 0
+        i = 0
+        while total < 64 * 1024 * 1024:
+            size = random.randint(1, 8) * 1024 * 1024
+            if kind == 'random':
+                data = os.urandom(size)
+            else:
+                data = ' '.join(random.choice(words) for _ in range(size // 8))[:size]
+            with open(os.path.join(directory, kind + '%03d.dat' % i), 'wb') as f:
+                f.write(data)
+            total += size
+            i += 1
+
+
+def main():
+    temp_dir = None
+    if len(sys.argv) > 1:
+        directory = sys.argv[1]
+    else:
+        directory = temp_dir = tempfile.mkdtemp()
+        synthetic_dataset(directory)
+    try:
+        files = []
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                files.append((path, os.path.relpath(path, directory)))
+        size = sum(os.path.getsize(path) for path, _ in files)
+        print('%d files, %.0f MiB' % (len(files), size / 1024.0 / 1024.0))
+        print('%-24s %10s %14s' % ('format', 'MB/s', 'archive / data'))
+        for name, func, arg in (('zip (stored)', write_zip, ZIP_STORED), ('zip (deflated)', write_zip, ZIP_DEFLATED),
+                                ('tar', write_tar, ''), ('tar.gz', write_tar, 'gz')):
+            elapsed, length = bench(func, files, arg)
+            print('%-24s %10.0f %14.3f' % (name, size / elapsed / (1024 * 1024), float(length) / size))
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark of MFResponse.recv for large responses: a result XML document of increasing size, and a service
+output of increasing size written to a file.
+
+usage: python benchmarks/bench_mfresponse.py [max_size_in_MiB]
+
+The response is sent by a thread over a socket pair, so that the figures measure the receive path rather than the
+network. The time per MiB stays constant as the size grows when the receive path runs in linear time.
+"""
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from mfclient import MFOutput, MFResponse
+
+MiB = 1024 * 1024
+
+
+def packet(length, remaining, mime_type):
+    return '\x01\x00' + struct.pack('>qih', length, remaining, len(mime_type)) + mime_type
+
+
+def result_xml(size):
+    item = '<item id="1">' + 'x' * 100 + '</item>'
+    items = item * (size // len(item))
+    return '<response><reply type="result"><result>' + items + '</result></reply></response>'
+
+
+def send_response(sock, xml, output_size):
+    body_length = 16 + 8 + len(xml) + (16 + 24 + output_size if output_size else 0)
+    sock.sendall('HTTP/1.1 200 OK\r\nContent-Type: application/mflux\r\nContent-Length: %d\r\n\r\n' % body_length)
+    sock.sendall(packet(len(xml), 1 if output_size else 0, 'text/xml'))
+    sock.sendall(xml)
+    if output_size:
+        sock.sendall(packet(output_size, 0, 'application/octet-stream'))
+        block = os.urandom(MiB)
+        for position in xrange(0, output_size, MiB):
+            sock.sendall(block[:min(MiB, output_size - position)])
+    sock.close()
+
+
+def bench(xml, output_size, outputs):
+    server, client = socket.socketpair()
+    sender = threading.Thread(target=send_response, args=(server, xml, output_size))
+    start = time.time()
+    sender.start()
+    response = MFResponse(outputs)
+    response.recv(client)
+    elapsed = time.time() - start
+    sender.join()
+    client.close()
+    return elapsed
+
+
+def main():
+    max_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    print('%-28s %10s %12s' % ('response', 'seconds', 's per MiB'))
+    size = 1
+    while size <= max_size:
+        xml = result_xml(size * MiB)
+        elapsed = bench(xml, 0, None)
+        print('%-28s %10.3f %12.4f' % ('result xml %d MiB' % size, elapsed, elapsed / size))
+        size *= 4
+    fd, path = tempfile.mkstemp(prefix='bench_mfresponse_')
+    os.close(fd)
+    try:
+        size = 4
+        while size <= max_size * 4:
+            elapsed = bench(result_xml(1024), size * MiB, [MFOutput(path)])
+            assert os.path.getsize(path) == size * MiB
+            print('%-28s %10.3f %12.4f' % ('output %d MiB' % size, elapsed, elapsed / size))
+            size *= 4
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Micro-benchmark of WZipFile.writeobj throughput for sources without a file descriptor (the buffered copy loop).
+
+usage: python benchmarks/bench_wzipfile.py [size_in_MiB]
+
+It compares reading the source with read() in 8 KiB blocks (the loop writeobj used to run) with reading it
+with readinto() into the reusable buffer, for several block sizes, with the CRC computed and with the CRC known
+in advance. The archive is written to a sink which discards the data, so that the figures measure the copy loop
+rather than the disk.
+
+It then compares ZIP_DEFLATED throughput of compressible data with deflate_threads from 1 up to the number of
+CPUs.
+"""
+import io
+import os
+import random
+import sys
+import time
+from multiprocessing import cpu_count
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+from zlib import crc32
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from wzipfile import WZipFile
+
+
+class NullSink(object):
+    def __init__(self):
+        self._position = 0
+
+    def write(self, data):
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        self._position = offset
+
+    def flush(self):
+        pass
+
+
+class ReadOnly(object):
+    """Source which only has read(), like the file objects of some storage backends."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def read(self, n=-1):
+        return self._f.read(n)
+
+
+def bench(data, wrap, block_size, crc=None, repeat=3):
+    best = None
+    for _ in range(repeat):
+        source = wrap(io.BytesIO(data))
+        start = time.time()
+        with WZipFile(NullSink(), 'w', ZIP_STORED, allowZip64=True, block_size=block_size) as wzipfile:
+            wzipfile.writeobj(source, len(data), 'data.bin', crc=crc)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data) / best / (1024 * 1024)
+
+
+def bench_deflate(data, threads, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        with WZipFile(NullSink(), 'w', ZIP_DEFLATED, allowZip64=True, deflate_threads=threads) as wzipfile:
+            wzipfile.writeobj(io.BytesIO(data), len(data), 'data.txt')
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data) / best / (1024 * 1024)
+
+
+def compressible(size):
+    words = [os.urandom(random.randint(2, 10)).encode('hex') for _ in range(4096)]
+    chunk = ' '.join(random.choice(words) for _ in range(256 * 1024))[:1024 * 1024]
+    return (chunk * (size // len(chunk) + 1))[:size]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    data = os.urandom(size * 1024 * 1024)
+    crc = crc32(data) & 0xffffffff
+    print('%-24s %14s %14s' % ('source / block size', 'MB/s with CRC', 'MB/s CRC known'))
+    print('%-24s %14.0f %14.0f' % ('read() / 8 KiB', bench(data, ReadOnly, 8 * 1024),
+                                   bench(data, ReadOnly, 8 * 1024, crc)))
+    for block_size in (8 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        print('%-24s %14.0f %14.0f' % ('readinto() / %d KiB' % (block_size / 1024),
+                                       bench(data, lambda f: f, block_size), bench(data, lambda f: f, block_size, crc)))
+    data = compressible(size * 1024 * 1024 // 4)
+    print('')
+    print('%-24s %14s' % ('deflate threads', 'MB/s'))
+    threads = 1
+    while threads <= cpu_count():
+        print('%-24d %14.0f' % (threads, bench_deflate(data, threads)))
+        threads *= 2
+
+
+if __name__ == '__main__':
+    main()
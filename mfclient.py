@@ -1,7 +1,9 @@
 import base64
 import datetime
 import os
+import errno
 import re
+import select
 import socket
 import ssl
 import struct
@@ -10,6 +12,12 @@ import time
 import urllib
 import xml.etree.ElementTree as ElementTree
 
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
 
 ##############################################################################
 # XML                                                                        #
@@ -512,7 +520,7 @@ class XmlStringWriter(object):
 
         :param name: name of the element
         :type name: str
-        :param value: value of the element
+        :param value: value of the element, encoded in UTF-8 if it is unicode
         :param attributes: attributes of the element
         :type attributes: dict
         :return:
@@ -527,7 +535,7 @@ class XmlStringWriter(object):
             self._items.append(attributes[a])
             self._items.append('"')
         self._items.append('>')
-        self._items.append(str(value))
+        self._items.append(value.encode('utf-8') if isinstance(value, unicode) else str(value))
         self._items.append('</')
         self._items.append(name)
         self._items.append('>')
@@ -668,10 +676,32 @@ class XmlDocWriter(object):
 
 BUFFER_SIZE = 8192
 RECV_TIMEOUT = 10.0
+# seconds a kept-alive socket may stay idle before it is closed rather than reused
+IDLE_TIMEOUT = 60.0
 SVC_URL = '/__mflux_svc__/'
 
 
+def create_ssl_context(verify=True, cafile=None, ciphers=None):
+    """Returns an ssl context for MFConnection, which can be shared by the connections to the same servers so that
+    the certificates and cipher list are loaded once. With verify=False, the certificate of the server is not
+    checked."""
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if ciphers:
+        context.set_ciphers(ciphers)
+    if getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols(['http/1.1'])
+    return context
+
+
 class MFConnection(object):
+    """Connection to a Mediaflux server. The socket is kept open and reused by the following service calls, as
+    advertised by the keep-alive http header, unless the server closes it or it stays idle longer than
+    idle_timeout seconds. A call is retried once over a new socket if the server closed the socket it reused before
+    replying, unless the request has inputs. The service calls of a connection are serialized.
+    """
     _SEQUENCE_GENERATOR = 0
     _SEQUENCE_ID = 0
     _LOCK = threading.RLock()
@@ -693,7 +723,8 @@ class MFConnection(object):
             return cls._SEQUENCE_ID
 
     def __init__(self, host, port, encrypt, proxy=None, app=None,
-                 protocols=None, timeout=None, recv_timeout=RECV_TIMEOUT, compress=False, cookie=None):
+                 protocols=None, timeout=None, recv_timeout=RECV_TIMEOUT, compress=False, cookie=None,
+                 idle_timeout=IDLE_TIMEOUT, ssl_context=None):
         self._host = host
         self._port = port
         self._encrypt = encrypt
@@ -716,11 +747,22 @@ class MFConnection(object):
         self._session_timeout = -1
         self._last_send_time = -1
         self._sock = None
+        self._idle_timeout = idle_timeout
+        self._sock_idle_since = None
+        self._ssl_context = ssl_context
 
     @property
     def session(self):
         return self._session
 
+    @property
+    def session_expiry(self):
+        """The time (in seconds since the epoch) at which the session expires unless it is used, or None if
+        there is no session."""
+        if not self._session or self._session_timeout < 0:
+            return None
+        return (self._last_send_time + self._session_timeout) / 1000.0
+
     def _open_socket(self):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.settimeout(self._timeout)
@@ -753,12 +795,42 @@ class MFConnection(object):
         else:
             self._sock.connect((self._host, self._port))
         if self._encrypt:
-            self._sock = ssl.wrap_socket(self._sock)
+            self._wrap_socket()
+
+    def _wrap_socket(self):
+        if self._ssl_context is None:
+            # no certificate verification, as with ssl.wrap_socket
+            self._ssl_context = create_ssl_context(verify=False)
+        try:
+            self._sock = self._ssl_context.wrap_socket(self._sock, server_hostname=self._host)
+        except:
+            self._sock.close()
+            self._sock = None
+            raise
 
     def _close_socket(self):
         if self._sock is not None:
             self._sock.close()
             self._sock = None
+            self._sock_idle_since = None
+
+    def _reusable_socket(self):
+        """Returns True if the open socket can be reused. Otherwise it is closed: it has been idle for too long, or
+        it is readable while no request is pending, which means that the server closed it."""
+        if self._sock is None:
+            return False
+        idle = time.time() - self._sock_idle_since
+        if self._idle_timeout is not None and idle > self._idle_timeout:
+            self._close_socket()
+            return False
+        try:
+            readable = select.select([self._sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            readable = True
+        if readable:
+            self._close_socket()
+            return False
+        return True
 
     def set_app(self, app):
         self._app = app
@@ -772,32 +844,41 @@ class MFConnection(object):
     def set_timeout(self, timeout):
         self._timeout = timeout
 
+    def set_idle_timeout(self, idle_timeout):
+        self._idle_timeout = idle_timeout
+
     def connect(self, domain=None, user=None, password=None, token=None):
         if not (domain and user and password) and not token and not self._session:
             raise ValueError('Cannot open connection: No user credentials or secure identity token is specified.')
         with self._lock:
-            w = XmlStringWriter('args')
-            if self._app is not None:
-                w.add('app', self._app)
-            w.add('host', self._host)
-            if domain and user and password:
-                self._domain = domain
-                self._user = user
-                self._password = password
-                w.add('domain', domain)
-                w.add('user', user)
-                w.add('password', password)
-            elif token:
-                w.add('token', token)
-                self._token = token
-            else:
-                w.add('sid', self._session)
-            rxe = self.execute('system.logon', args=w.doc_text())
-            self._session = rxe.value('session')
-            self._session_id = rxe.int_value('session/@id')
-            self._session_timeout = rxe.int_value('session/@timeout', 600000) * 1000
-            self._last_send_time = int(round(time.time() * 1000))
-            return self._session
+            rxe = self.execute('system.logon', args=self._logon_args(domain, user, password, token))
+            return self._logged_on(rxe)
+
+    def _logon_args(self, domain=None, user=None, password=None, token=None):
+        w = XmlStringWriter('args')
+        if self._app is not None:
+            w.add('app', self._app)
+        w.add('host', self._host)
+        if domain and user and password:
+            self._domain = domain
+            self._user = user
+            self._password = password
+            w.add('domain', domain)
+            w.add('user', user)
+            w.add('password', password)
+        elif token:
+            w.add('token', token)
+            self._token = token
+        else:
+            w.add('sid', self._session)
+        return w.doc_text()
+
+    def _logged_on(self, rxe):
+        self._session = rxe.value('session')
+        self._session_id = rxe.int_value('session/@id')
+        self._session_timeout = rxe.int_value('session/@timeout', 600000) * 1000
+        self._last_send_time = int(round(time.time() * 1000))
+        return self._session
 
     def disconnect(self):
         if not self._session:
@@ -807,30 +888,85 @@ class MFConnection(object):
                 self.execute('system.logoff')
             finally:
                 self._session = None
+                self._close_socket()
+
+    def close(self):
+        """Closes the socket kept open, without logging off."""
+        with self._lock:
+            self._close_socket()
 
     def execute(self, service, args=None, inputs=None, outputs=None, route=None, emode=None):
+        """Executes the service and returns its result. If the server replies that the session is no longer valid
+        (logged off, expired, or the server restarted), the connection logs on again with the credentials or token
+        it logged on with, and the call is sent once more over a new socket: the inputs are sent again, so the
+        producers of MFStreamInput inputs must be callable more than once."""
+        with self._lock:
+            try:
+                return self._execute(service, args, inputs, outputs, route, emode)
+            except ExSessionInvalid:
+                if service in ('system.logon', 'system.logoff') or \
+                        not (self._token or (self._domain and self._user and self._password)):
+                    raise
+                self._session = None
+                self._close_socket()
+                self._logged_on(self._execute('system.logon', args=self._logon_args(
+                    self._domain, self._user, self._password, self._token)))
+                return self._execute(service, args, inputs, outputs, route, emode)
+
+    def _execute(self, service, args=None, inputs=None, outputs=None, route=None, emode=None):
+        request = self._request(service, args, inputs, outputs, route, emode)
+        with self._lock:
+            reused = self._reusable_socket()
+            while True:
+                response = MFResponse(outputs)
+                try:
+                    if self._sock is None:
+                        # open socket
+                        self._open_socket()
+                    self._last_send_time = int(round(time.time() * 1000))
+                    self._send_request(request)
+                    # receive http response
+                    response.recv(self._sock)
+                except Exception as e:
+                    self._close_socket()
+                    if reused and not inputs and not response.started and _connection_closed(e):
+                        # the server closed the socket it reused in the meantime: retry over a new socket
+                        reused = False
+                        continue
+                    raise
+                if response.keep_alive:
+                    self._sock_idle_since = time.time()
+                else:
+                    self._close_socket()
+                if response.error is not None:
+                    if _session_invalid(response.error):
+                        raise ExSessionInvalid(str(response.error))
+                    raise ExHttpResponse(str(response.error))
+                return response.result
+
+    def _request(self, service, args=None, inputs=None, outputs=None, route=None, emode=None):
         sgen = MFConnection.sequence_generator()
         seq = MFConnection._next_sequence_id()
         # create request message
-        request = MFRequest(sgen, seq, service, args, inputs, outputs, route, emode, self._session,
-                            (self._token, self._token_type), self._app, self._protocols, self._compress)
-        try:
-            # open socket
-            self._open_socket()
-            # send http header
-            self._send_http_header(request.length)
-            # send http request
+        return MFRequest(sgen, seq, service, args, inputs, outputs, route, emode, self._session,
+                         (self._token, self._token_type), self._app, self._protocols, self._compress)
+
+    def _send_request(self, request):
+        # send http header
+        content_length = request.length
+        self._send_http_header(content_length)
+        # send http request
+        if content_length == -1:
+            writer = _ChunkedWriter(self._sock)
+            request.send(writer)
+            writer.close()
+        else:
             request.send(self._sock)
-            # receive http response
-            response = MFResponse(outputs)
-            response.recv(self._sock)
-            if response.error is not None:
-                raise ExHttpResponse(str(response.error))
-            return response.result
-        finally:
-            self._close_socket()
 
     def _send_http_header(self, content_length):
+        self._sock.sendall(self._http_header(content_length))
+
+    def _http_header(self, content_length):
         header = 'POST '
         if self._encrypt:
             header += 'https://'
@@ -857,7 +993,7 @@ class MFConnection(object):
         else:
             header += 'Content-Length: ' + str(content_length) + '\r\n'
         header += '\r\n'
-        self._sock.sendall(header)
+        return header
 
 
 class MFInput(object):
@@ -905,6 +1041,51 @@ class MFInput(object):
         self._checksum = checksum
 
 
+class MFStreamInput(object):
+    """Service input whose content is generated on the fly instead of read from a file or url.
+
+    The producer is called with a writable file-like object when the request is being sent, so the
+    content goes straight to the socket as it is produced. If the length is unknown (-1), the request is
+    sent with chunked transfer encoding and the input must be the last one of the request.
+    """
+
+    def __init__(self, producer, mime_type=None, length=-1):
+        """
+
+        :param producer: callable which takes a file-like object and writes the content to it
+        :type producer: callable
+        :param mime_type: mime type of the content
+        :type mime_type: str
+        :param length: length of the content, or -1 if unknown
+        :type length: int
+        """
+        self._producer = producer
+        self._type = mime_type
+        self._length = length
+        self._checksum = None
+
+    def producer(self):
+        return self._producer
+
+    def type(self):
+        return self._type
+
+    def set_type(self, mime_type):
+        self._type = mime_type
+
+    def length(self):
+        return self._length
+
+    def url(self):
+        return None
+
+    def checksum(self):
+        return self._checksum
+
+    def set_checksum(self, checksum):
+        self._checksum = checksum
+
+
 class MFOutput(object):
     def __init__(self, path):
         self._path = os.path.abspath(path)
@@ -928,18 +1109,22 @@ class MFOutput(object):
 
 class MFRequest(object):
     class Packet(object):
-        def __init__(self, string=None, url=None, length=None, mime_type=None, compress=False,
+        def __init__(self, string=None, url=None, producer=None, length=None, mime_type=None, compress=False,
                      buffer_size=BUFFER_SIZE):
+            self._bytes = None
+            self._url = None
+            self._producer = None
             if string:
                 self._bytes = string.encode('utf-8')
-                self._url = None
                 self._length = len(self._bytes)
             elif url:
-                self._bytes = None
                 self._url = url
                 self._length = length
+            elif producer:
+                self._producer = producer
+                self._length = length
             else:
-                raise ValueError('Either str or url argument is required.')
+                raise ValueError('Either str, url or producer argument is required.')
             self._type = mime_type
             self._compress = compress
             self._buffer_size = buffer_size
@@ -986,7 +1171,7 @@ class MFRequest(object):
             if self._bytes is not None:
                 sock.sendall(self._bytes)
             elif self._url is not None:
-                f = open(self._url[5:]) if self._url.startswith('file:') else urllib.urlopen(self._url)
+                f = _open_url(self._url)
                 try:
                     chunk = f.read(self._buffer_size)
                     while len(chunk) > 0:
@@ -994,6 +1179,13 @@ class MFRequest(object):
                         chunk = f.read(self._buffer_size)
                 finally:
                     f.close()
+            elif self._producer is not None:
+                f = _PacketWriter(sock, self._buffer_size * 8)
+                self._producer(f)
+                f.flush()
+                if self._length != -1 and f.tell() != self._length:
+                    raise IOError('Packet content length mismatch. Expecting ' + str(self._length) + ', found ' +
+                                  str(f.tell()))
 
     def __init__(self, sgen, seq, service, args=None, inputs=None, outputs=None, route=None, emode=None, session=None,
                  token=None, app=None,
@@ -1005,9 +1197,14 @@ class MFRequest(object):
         self._packets.append(MFRequest.Packet(string=xml, mime_type='text/xml', compress=compress))
         if inputs is not None:
             for mi in inputs:
-                self._packets.append(
-                    MFRequest.Packet(url=mi.url(), length=mi.length(), mime_type=mi.type(),
-                                     compress=False))
+                if isinstance(mi, MFStreamInput):
+                    self._packets.append(
+                        MFRequest.Packet(producer=mi.producer(), length=mi.length(), mime_type=mi.type(),
+                                         compress=False))
+                else:
+                    self._packets.append(
+                        MFRequest.Packet(url=mi.url(), length=mi.length(), mime_type=mi.type(),
+                                         compress=False))
 
     @classmethod
     def _create_request_xml(cls, sgen, seq, service, args=None, inputs=None, outputs=None, route=None, emode=None,
@@ -1064,6 +1261,55 @@ class MFRequest(object):
         return self._packets.__len__()
 
 
+class _PacketWriter(object):
+    """Write-only file-like object which buffers the content produced for a packet and sends it to the
+    socket. It keeps count of the bytes written so that it can be used as the output of ZipFile. The data
+    written is copied, so the caller can reuse its buffers.
+    """
+
+    def __init__(self, sock, buffer_size):
+        self._sock = sock
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._written = 0L
+
+    def write(self, data):
+        if not data:
+            return
+        self._written += len(data)
+        if not self._buffer and len(data) >= self._buffer_size:
+            self._sock.sendall(data)
+            return
+        self._buffer.extend(data)
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def tell(self):
+        return self._written
+
+    def flush(self):
+        if self._buffer:
+            self._sock.sendall(self._buffer)
+            del self._buffer[:]
+
+
+class _ChunkedWriter(object):
+    """Wraps the socket to send the http request body with chunked transfer encoding."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def sendall(self, data):
+        if data:
+            chunk = bytearray('%x\r\n' % len(data))
+            chunk.extend(data)
+            chunk.extend('\r\n')
+            self._sock.sendall(chunk)
+
+    def close(self):
+        self._sock.sendall('0\r\n\r\n')
+
+
 class MFResponse(object):
     def __init__(self, outputs):
         if outputs is None:
@@ -1080,59 +1326,54 @@ class MFResponse(object):
         self._http_header_fields = {}
         self._result = None
         self._error = None
+        self._started = False
+        self._keep_alive = False
 
     @property
     def result(self):
         return self._result
 
+    @property
+    def started(self):
+        """True once any byte of the response has been received."""
+        return self._started
+
+    @property
+    def keep_alive(self):
+        """True if the response has been received completely and the server keeps the connection open."""
+        return self._keep_alive
+
     @property
     def error(self):
         return self._error
 
     def recv(self, sock):
-        bytes_received = self._recv_header(sock)
+        buf = _RecvBuffer(sock)
+        self._recv_header(buf)
         pkt_idx = 0  # packet index
         while True:
-            bytes_length = len(bytes_received)
-            if bytes_length < 16:
-                data = sock.recv(BUFFER_SIZE)
-                if not data:
-                    raise ExHttpResponse('Incomplete packet ' + pkt_idx + '.')
-                else:
-                    bytes_received += data
-                    continue
-            pkt_length = struct.unpack('>q', bytes_received[2:10])[0]
-            pkt_remaining = struct.unpack('>i', bytes_received[10:14])[0]
-            pkt_mime_type_length = struct.unpack('>h', bytes_received[14:16])[0]
-            if pkt_mime_type_length <= 0:
-                bytes_received = self._recv_packet(sock, pkt_idx, pkt_length, None, bytes_received, pkt_remaining)
-                pkt_idx += 1
-            else:
-                if bytes_length < (16 + pkt_mime_type_length):
-                    data = sock.recv(BUFFER_SIZE)
-                    if not data:
-                        raise ExHttpResponse('Incomplete packet ' + pkt_idx + '.')
-                    else:
-                        bytes_received += data
-                        continue
-                pkt_mime_type = bytes_received[16:16 + pkt_mime_type_length]
-                bytes_received = bytes_received[16 + pkt_mime_type_length:]
-                bytes_received = self._recv_packet(sock, pkt_idx, pkt_length, pkt_mime_type, bytes_received,
-                                                   pkt_remaining)
-                pkt_idx += 1
+            if not buf.ensure(16):
+                raise ExHttpResponse('Incomplete packet ' + str(pkt_idx) + '.')
+            pkt_length, pkt_remaining, pkt_mime_type_length = struct.unpack_from('>qih', buf.view(16), 2)
+            buf.consume(16)
+            pkt_mime_type = None
+            if pkt_mime_type_length > 0:
+                if not buf.ensure(pkt_mime_type_length):
+                    raise ExHttpResponse('Incomplete packet ' + str(pkt_idx) + '.')
+                pkt_mime_type = str(buf.view(pkt_mime_type_length))
+                buf.consume(pkt_mime_type_length)
+            self._recv_packet(buf, pkt_idx, pkt_length, pkt_mime_type, pkt_remaining)
+            pkt_idx += 1
             if pkt_remaining == 0:
                 break
+        self._keep_alive = not len(buf) and self._http_keep_alive()
 
-    def _recv_packet(self, sock, idx, length, mime_type, bytes_received, remaining):
-        n = len(bytes_received)
+    def _recv_packet(self, buf, idx, length, mime_type, remaining):
         if idx == 0:  # first packet: result/error xml
-            while len(bytes_received) < length:
-                data = sock.recv(BUFFER_SIZE)
-                if not data:
-                    raise ExHttpResponse('Incomplete packet ' + idx + '.')
-                bytes_received += data
-            self._parse_reply(bytes_received[0:length])
-            bytes_received = bytes_received[length:]
+            if not buf.ensure(length):
+                raise ExHttpResponse('Incomplete packet ' + str(idx) + '.')
+            self._parse_reply(buf.view(length))
+            buf.consume(length)
             # now check outputs
             nb_outputs = len(self._outputs)
             if remaining != nb_outputs:
@@ -1143,31 +1384,18 @@ class MFResponse(object):
             if mime_type:
                 output.set_mime_type(mime_type)
             with open(output.path(), 'wb') as f:
-                if n < length:
-                    if n > 0:
-                        f.write(bytes_received)
-                        f.flush()
-                        # print('written: ' + str(n))
-                    while n < length:
-                        data = sock.recv(BUFFER_SIZE)
-                        if not data:
-                            raise IOError('Failed to receive data for packet: ' + idx)
-                        if n + len(data) < length:
-                            f.write(data)
-                            n += len(data)
-                        else:
-                            f.write(data[0:length - n])
-                            bytes_received = data[length - n:]
-                            n = length
-                        f.flush()
-                        # print('written: ' + str(n))
-                else:
-                    f.write(bytes_received[0:length])
-                    bytes_received = bytes_received[length:]
-        return bytes_received
+                n = 0
+                while n < length:
+                    if not len(buf) and not buf.fill():
+                        raise IOError('Failed to receive data for packet: ' + str(idx))
+                    # written straight from the receive buffer
+                    size = min(len(buf), length - n)
+                    f.write(buf.view(size))
+                    buf.consume(size)
+                    n += size
 
     def _parse_reply(self, text):
-        rxe = XmlElement.parse(text)
+        rxe = XmlElement(ElementTree.fromstring(text))
         reply_type = rxe.value('reply/@type')
         if reply_type == 'result':
             self._result = rxe.element('reply/result')
@@ -1175,25 +1403,23 @@ class MFResponse(object):
             assert reply_type == 'error'
             self._error = rxe.element('reply')
 
-    def _recv_header(self, sock):
+    def _http_keep_alive(self):
+        connection = ''.join(v for k, v in self._http_header_fields.items() if k.lower() == 'connection').lower()
+        return connection != 'close' and (self._http_version != '1.0' or connection == 'keep-alive')
+
+    def _recv_header(self, buf):
         # receive header
-        header = ''
-        bytes_received = ''
-        completed = False
-        while not completed:
-            data = sock.recv(BUFFER_SIZE)
-            if not data:
-                break
-            end = data.find('\r\n\r\n')  # end of header
+        scanned = 0
+        while True:
+            end = buf.find('\r\n\r\n', scanned)  # end of header
             if end >= 0:
-                header += data[0:end]
-                completed = True
-                bytes_received += data[end + 4:]
                 break
-            else:
-                header += data
-        if not completed:
-            raise ExHttpResponse('Failed to receive http header. Incomplete header: ' + header)
+            scanned = max(0, len(buf) - 3)
+            if not buf.fill():
+                raise ExHttpResponse('Failed to receive http header. Incomplete header: ' + str(buf.view(len(buf))))
+            self._started = True
+        header = str(buf.view(end))
+        buf.consume(end + 4)
         # parse header fields
         self._parse_header(header)
         # handle status code
@@ -1203,7 +1429,7 @@ class MFResponse(object):
             raise ExHttpResponse("Invalid http response: missing status message.")
         if self._http_status_code == '200':
             # 200: success
-            return bytes_received
+            return
         elif self._http_status_code == '407':
             # 407: proxy auth required
             raise ExProxyAuthenticationRequired('Proxy authentication required.')
@@ -1215,22 +1441,24 @@ class MFResponse(object):
                 content_length = long(self._http_header_fields['Content-Length'])
                 idx = content_type.find('charset=')
                 encoding = None if idx == -1 else content_type[idx + 8:]
-                content = ''
-                while True:
-                    data = sock.recv(BUFFER_SIZE)
-                    content += data
-                    if data == '' or len(content) >= content_length:
-                        break
-                    if encoding is not None:
-                        content = content.decode(encoding)
-                raise ExHttpResponse(
-                    'Invalid HTTP/' + self._http_version + ' response: ' + self._http_status_code + ' ' +
-                    self._http_status_message + '. Content: ' + content)
+                while len(buf) < content_length and buf.fill():
+                    pass
+                content = str(buf.view(min(len(buf), content_length)))
+                if encoding is not None:
+                    content = content.decode(encoding)
+                raise self._http_error(content)
             else:
                 # Error without content/message
-                raise ExHttpResponse(
-                    'Invalid HTTP/' + self._http_version + ' response: ' + self._http_status_code + ' ' +
-                    self._http_status_message + '.')
+                raise self._http_error()
+
+    def _http_error(self, content=None):
+        if content is not None:
+            return ExHttpResponse(
+                'Invalid HTTP/' + self._http_version + ' response: ' + self._http_status_code + ' ' +
+                self._http_status_message + '. Content: ' + content)
+        return ExHttpResponse(
+            'Invalid HTTP/' + self._http_version + ' response: ' + self._http_status_code + ' ' +
+            self._http_status_message + '.')
 
     def _parse_header(self, header):
         lines = header.split('\r\n')
@@ -1248,6 +1476,375 @@ class MFResponse(object):
             self._http_header_fields[kv[0]] = kv[1].strip()
 
 
+class _RecvBuffer(object):
+    """Receive buffer of a socket: one bytearray filled by recv_into() and consumed from its start. When it is
+    full, the bytes not consumed yet are moved to its front if that frees at least half of it, otherwise it is
+    doubled, so each byte received is copied a bounded number of times. view() returns a buffer on the bytes not
+    consumed yet, which is only valid until the next fill().
+    """
+
+    def __init__(self, sock, size=BUFFER_SIZE * 8):
+        self._sock = sock
+        self._buffer = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def fill(self):
+        """Receives more bytes. Returns the number of bytes received, 0 at the end of the stream."""
+        if self._end == len(self._buffer):
+            if self._start >= len(self._buffer) // 2:
+                self._buffer[0:self._end - self._start] = self._buffer[self._start:self._end]
+                self._end -= self._start
+                self._start = 0
+            else:
+                self._buffer.extend(bytearray(len(self._buffer)))
+        n = self._sock.recv_into(memoryview(self._buffer)[self._end:])
+        self._end += n
+        return n
+
+    def ensure(self, size):
+        """Receives bytes until size bytes are available. Returns False if the stream ends before."""
+        while len(self) < size:
+            if not self.fill():
+                return False
+        return True
+
+    def view(self, size):
+        return buffer(self._buffer, self._start, size)
+
+    def find(self, sub, start=0):
+        index = self._buffer.find(sub, self._start + start, self._end)
+        return index - self._start if index >= 0 else -1
+
+    def consume(self, size):
+        self._start += size
+        if self._start == self._end:
+            self._start = self._end = 0
+
+
+def _connection_closed(e):
+    """Returns True if the exception means that the peer closed the connection before replying."""
+    if isinstance(e, ExHttpResponse):
+        return str(e).startswith('Failed to receive http header.')
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def _coroutine(func):
+    return asyncio.coroutine(func) if asyncio is not None else func
+
+
+# maximum number of service calls of an AsyncMFConnection in flight, each over its own socket
+MAX_STREAMS = 16
+# number of blocks produced by an MFStreamInput ahead of the socket
+_PRODUCER_AHEAD = 4
+
+
+class AsyncMFConnection(object):
+    """asyncio counterpart of MFConnection, built on trollius (asyncio for Python 2). The service calls are
+    coroutines sending the same requests as MFConnection, so that one thread can have many calls in flight: each
+    call runs over its own kept-alive stream, at most max_streams at a time. The data of MFStreamInput
+    producers is produced in a separate thread.
+
+    The connection shares the session, credentials and settings of an MFConnection, which can be logged on by
+    either of them: from_connection() wraps a connection already logged on by the blocking API, and
+    execute_all() runs service calls concurrently from blocking code. Proxies are not supported.
+    """
+
+    def __init__(self, host, port, encrypt, max_streams=MAX_STREAMS, loop=None, **kwargs):
+        self._init(MFConnection(host, port, encrypt, **kwargs), max_streams, loop)
+
+    @classmethod
+    def from_connection(cls, cxn, max_streams=MAX_STREAMS, loop=None):
+        acxn = cls.__new__(cls)
+        acxn._init(cxn, max_streams, loop)
+        return acxn
+
+    def _init(self, cxn, max_streams, loop):
+        if asyncio is None:
+            raise RuntimeError('AsyncMFConnection requires the trollius package.')
+        if cxn._proxy is not None:
+            raise ValueError('AsyncMFConnection does not support proxies.')
+        self._cxn = cxn
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._streams = asyncio.Semaphore(max_streams, loop=self._loop)
+        # (reader, writer, idle since), least recently used first
+        self._idle = []
+
+    @property
+    def connection(self):
+        return self._cxn
+
+    @property
+    def session(self):
+        return self._cxn.session
+
+    @_coroutine
+    def connect(self, domain=None, user=None, password=None, token=None):
+        cxn = self._cxn
+        if not (domain and user and password) and not token and not cxn.session:
+            raise ValueError('Cannot open connection: No user credentials or secure identity token is specified.')
+        rxe = yield From(self.execute('system.logon', args=cxn._logon_args(domain, user, password, token)))
+        raise Return(cxn._logged_on(rxe))
+
+    @_coroutine
+    def disconnect(self):
+        if not self._cxn.session:
+            return
+        try:
+            yield From(self.execute('system.logoff'))
+        finally:
+            self._cxn._session = None
+            self.close()
+
+    def close(self):
+        """Closes the streams kept open, without logging off."""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    @_coroutine
+    def execute(self, service, args=None, inputs=None, outputs=None, route=None, emode=None):
+        request = self._cxn._request(service, args, inputs, outputs, route, emode)
+        yield From(self._streams.acquire())
+        try:
+            stream = self._reusable_stream()
+            reused = stream is not None
+            while True:
+                response = MFResponse(outputs)
+                try:
+                    if stream is None:
+                        stream = yield From(self._open_stream())
+                    self._cxn._last_send_time = int(round(time.time() * 1000))
+                    yield From(self._send_request(stream[1], request))
+                    yield From(self._recv_response(stream[0], response))
+                except Exception as e:
+                    if stream is not None:
+                        stream[1].close()
+                        stream = None
+                    if reused and not inputs and not response.started and \
+                            (isinstance(e, asyncio.IncompleteReadError) or _connection_closed(e)):
+                        # the server closed the stream it reused in the meantime: retry over a new stream
+                        reused = False
+                        continue
+                    raise
+                break
+            if response.keep_alive:
+                self._idle.append((stream[0], stream[1], time.time()))
+            else:
+                stream[1].close()
+        finally:
+            self._streams.release()
+        if response.error is not None:
+            raise ExHttpResponse(str(response.error))
+        raise Return(response.result)
+
+    def _reusable_stream(self):
+        """Returns the most recently used idle stream, or None. The streams idle for longer than idle_timeout, the
+        least recently used first, are closed."""
+        idle_timeout = self._cxn._idle_timeout
+        if idle_timeout is not None:
+            now = time.time()
+            while self._idle and now - self._idle[0][2] > idle_timeout:
+                self._idle.pop(0)[1].close()
+        while self._idle:
+            reader, writer, _ = self._idle.pop()
+            if reader.at_eof():
+                writer.close()
+                continue
+            return reader, writer
+        return None
+
+    @_coroutine
+    def _open_stream(self):
+        cxn = self._cxn
+        kwargs = {}
+        if cxn._encrypt:
+            if cxn._ssl_context is None:
+                # no certificate verification, as with MFConnection
+                cxn._ssl_context = create_ssl_context(verify=False)
+            kwargs = {'ssl': cxn._ssl_context, 'server_hostname': cxn._host}
+        connection = asyncio.open_connection(cxn._host, cxn._port, loop=self._loop, **kwargs)
+        if cxn._timeout is not None:
+            connection = asyncio.wait_for(connection, cxn._timeout, loop=self._loop)
+        stream = yield From(connection)
+        raise Return(stream)
+
+    @_coroutine
+    def _send_request(self, writer, request):
+        content_length = request.length
+        writer.write(self._cxn._http_header(content_length))
+        sink = _StreamSink(writer)
+        if content_length == -1:
+            sink = _ChunkedWriter(sink)
+        remaining = len(request) - 1
+        for packet in request:
+            packet._send_header(sink, remaining)
+            if packet._bytes is not None:
+                sink.sendall(packet._bytes)
+            elif packet._url is not None:
+                # the file or url is opened and read in the executor of the loop, which must not block
+                f = yield From(self._loop.run_in_executor(None, _open_url, packet._url))
+                try:
+                    while True:
+                        chunk = yield From(self._loop.run_in_executor(None, f.read, packet._buffer_size))
+                        if not chunk:
+                            break
+                        sink.sendall(chunk)
+                        yield From(writer.drain())
+                finally:
+                    f.close()
+            elif packet._producer is not None:
+                yield From(self._send_produced(writer, sink, packet))
+            yield From(writer.drain())
+            remaining -= 1
+        if content_length == -1:
+            sink.close()
+        yield From(writer.drain())
+
+    @_coroutine
+    def _send_produced(self, writer, sink, packet):
+        """Sends the content of the packet written by its producer, which runs in a separate thread at most
+        _PRODUCER_AHEAD blocks ahead of the stream."""
+        chunks = asyncio.Queue(loop=self._loop)
+        slots = threading.Semaphore(_PRODUCER_AHEAD)
+        state = {'aborted': False, 'error': None, 'length': 0}
+        loop = self._loop
+
+        class QueueSink(object):
+            def sendall(self, data):
+                slots.acquire()
+                if state['aborted']:
+                    raise IOError('Request aborted.')
+                loop.call_soon_threadsafe(chunks.put_nowait, bytes(data))
+
+        def produce():
+            try:
+                f = _PacketWriter(QueueSink(), packet._buffer_size * 8)
+                packet._producer(f)
+                f.flush()
+                state['length'] = f.tell()
+            except Exception as e:
+                state['error'] = e
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+        thread = threading.Thread(target=produce, name='mfclient-async-producer')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                data = yield From(chunks.get())
+                if data is None:
+                    break
+                sink.sendall(data)
+                yield From(writer.drain())
+                slots.release()
+        except:
+            state['aborted'] = True
+            for _ in range(_PRODUCER_AHEAD + 1):
+                slots.release()
+            raise
+        if state['error'] is not None:
+            raise state['error']
+        if packet._length != -1 and state['length'] != packet._length:
+            raise IOError('Packet content length mismatch. Expecting ' + str(packet._length) + ', found ' +
+                          str(state['length']))
+
+    @_coroutine
+    def _recv_response(self, reader, response):
+        header = ''
+        while True:
+            line = yield From(reader.readline())
+            if not line:
+                raise ExHttpResponse('Failed to receive http header. Incomplete header: ' + header)
+            response._started = True
+            if line == '\r\n':
+                break
+            header += line
+        response._parse_header(header.rstrip('\r\n'))
+        if not response._http_status_code:
+            raise ExHttpResponse("Invalid http response: missing status code.")
+        if not response._http_status_message:
+            raise ExHttpResponse("Invalid http response: missing status message.")
+        if response._http_status_code == '407':
+            raise ExProxyAuthenticationRequired('Proxy authentication required.')
+        if response._http_status_code != '200':
+            content = None
+            if 'Content-Length' in response._http_header_fields:
+                content = yield From(reader.read(long(response._http_header_fields['Content-Length'])))
+            raise response._http_error(content)
+        pkt_idx = 0
+        while True:
+            head = yield From(reader.readexactly(16))
+            pkt_length, pkt_remaining, pkt_mime_type_length = struct.unpack('>qih', head[2:16])
+            pkt_mime_type = None
+            if pkt_mime_type_length > 0:
+                pkt_mime_type = yield From(reader.readexactly(pkt_mime_type_length))
+            if pkt_idx == 0:
+                # first packet: result/error xml
+                text = yield From(reader.readexactly(pkt_length))
+                response._parse_reply(text)
+                nb_outputs = len(response._outputs)
+                if pkt_remaining != nb_outputs:
+                    raise ExHttpResponse('Mismatch number of service outputs. Expecting ' + str(nb_outputs) +
+                                         ', found ' + str(pkt_remaining))
+            else:
+                output = response._outputs[pkt_idx - 1]
+                if pkt_mime_type:
+                    output.set_mime_type(pkt_mime_type)
+                # the file is opened and written in the executor of the loop, like the inputs are read. It is not
+                # buffered, so that closing it does not block.
+                f = yield From(self._loop.run_in_executor(None, open, output.path(), 'wb', 0))
+                try:
+                    n = 0
+                    while n < pkt_length:
+                        data = yield From(reader.readexactly(min(pkt_length - n, BUFFER_SIZE * 8)))
+                        yield From(self._loop.run_in_executor(None, f.write, data))
+                        n += len(data)
+                finally:
+                    f.close()
+            pkt_idx += 1
+            if pkt_remaining == 0:
+                break
+        response._keep_alive = response._http_keep_alive()
+
+
+class _StreamSink(object):
+    """Socket-like wrapper of an asyncio stream writer, for the request writers of MFConnection."""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def sendall(self, data):
+        self._writer.write(bytes(data))
+
+
+def execute_all(cxn, calls, max_streams=MAX_STREAMS):
+    """Runs the service calls concurrently over an AsyncMFConnection sharing the session of the MFConnection, and
+    waits for them. Each call is a tuple of the arguments of MFConnection.execute(). Returns the result of each
+    call, or the exception it raised, in order."""
+    if asyncio is None:
+        raise RuntimeError('execute_all requires the trollius package.')
+    loop = asyncio.new_event_loop()
+    try:
+        acxn = AsyncMFConnection.from_connection(cxn, max_streams, loop)
+        try:
+            tasks = [acxn.execute(*call) for call in calls]
+            return loop.run_until_complete(asyncio.gather(*tasks, loop=loop, return_exceptions=True))
+        finally:
+            acxn.close()
+            # let the transports close their sockets
+            loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    finally:
+        loop.close()
+
+
+def _open_url(url):
+    return open(url[5:]) if url.startswith('file:') else urllib.urlopen(url)
+
+
 class ExNotConnected(Exception):
     pass
 
@@ -1260,6 +1857,16 @@ class ExProxyAuthenticationRequired(Exception):
     pass
 
 
+class ExSessionInvalid(ExHttpResponse):
+    pass
+
+
+def _session_invalid(error):
+    """Returns True if the error reply means that the session of the request is no longer valid."""
+    text = (error.value('error') or '') + ' ' + (error.value('message') or '')
+    return 'ExSessionInvalid' in text or 'session is not valid' in text.lower()
+
+
 def _crc32(path):
     from zlib import crc32
     with open(path, 'r') as f:
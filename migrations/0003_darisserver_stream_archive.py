@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0002_load_initial_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='stream_archive',
+            field=models.BooleanField(default=False, help_text=b'Send archives while they are being created, without temporary files. Requires chunked transfer encoding.', verbose_name=b'Stream archives'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0003_darisserver_stream_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='max_connections',
+            field=models.PositiveIntegerField(default=1, help_text=b'Maximum number of datasets sent in parallel to the server by a task.', verbose_name=b'Max concurrent connections'),
+        ),
+    ]
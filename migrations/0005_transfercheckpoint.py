@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tardis_portal', '0001_initial'),
+        ('send_to_daris', '0004_darisserver_max_connections'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransferCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sent_time', models.DateTimeField(auto_now_add=True, verbose_name=b'Sent time')),
+                ('dataset', models.ForeignKey(to='tardis_portal.Dataset')),
+                ('experiment', models.ForeignKey(to='tardis_portal.Experiment')),
+                ('project', models.ForeignKey(to='send_to_daris.DarisProject')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='transfercheckpoint',
+            unique_together=set([('project', 'experiment', 'dataset')]),
+        ),
+    ]
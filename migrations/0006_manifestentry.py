@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tardis_portal', '0001_initial'),
+        ('send_to_daris', '0005_transfercheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='incremental_sync',
+            field=models.BooleanField(default=False, help_text=b'Only send the data files that are new or have changed since the dataset was last sent to the project.', verbose_name=b'Incremental sync'),
+        ),
+        migrations.CreateModel(
+            name='ManifestEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('size', models.BigIntegerField(verbose_name=b'Size')),
+                ('modification_time', models.DateTimeField(null=True, verbose_name=b'Modification time', blank=True)),
+                ('checksum', models.CharField(max_length=128, verbose_name=b'Checksum', blank=True)),
+                ('sent_time', models.DateTimeField(auto_now=True, verbose_name=b'Sent time')),
+                ('datafile', models.ForeignKey(to='tardis_portal.DataFile')),
+                ('dataset', models.ForeignKey(to='tardis_portal.Dataset')),
+                ('project', models.ForeignKey(to='send_to_daris.DarisProject')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='manifestentry',
+            unique_together=set([('project', 'datafile')]),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tardis_portal', '0001_initial'),
+        ('send_to_daris', '0006_manifestentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataFileCrc',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('size', models.BigIntegerField(verbose_name=b'Size')),
+                ('modification_time', models.DateTimeField(null=True, verbose_name=b'Modification time', blank=True)),
+                ('checksum', models.CharField(max_length=128, verbose_name=b'Checksum', blank=True)),
+                ('crc32', models.BigIntegerField(verbose_name=b'CRC32')),
+                ('datafile', models.OneToOneField(to='tardis_portal.DataFile')),
+            ],
+        ),
+    ]
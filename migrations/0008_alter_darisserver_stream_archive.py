@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0007_datafilecrc'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='darisserver',
+            name='stream_archive',
+            field=models.BooleanField(default=False, help_text=b'Send archives while they are being created, without temporary files.', verbose_name=b'Stream archives'),
+        ),
+    ]
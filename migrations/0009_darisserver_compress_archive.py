@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0008_alter_darisserver_stream_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='compress_archive',
+            field=models.BooleanField(default=False, help_text=b'Deflate the data files which compress well. Already compressed formats are always stored.', verbose_name=b'Compress archives'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0009_darisserver_compress_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='max_archive_size',
+            field=models.BigIntegerField(default=0, help_text=b'Split the datasets larger than this (in bytes) into several archives uploaded in parallel. 0 means no limit.', verbose_name=b'Max archive size'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0010_darisserver_max_archive_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='transfer_format',
+            field=models.CharField(default=b'zip', help_text=b'Send datasets as a zip archive, or send their data files as the attachments of one request without archiving them.', max_length=8, verbose_name=b'Transfer format', choices=[(b'zip', b'Zip archive'), (b'files', b'Data files')]),
+        ),
+    ]
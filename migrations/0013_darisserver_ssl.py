@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('send_to_daris', '0012_alter_darisserver_transfer_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='darisserver',
+            name='verify_certificate',
+            field=models.BooleanField(default=False, help_text=b'Check the certificate of the server over HTTPS. Off by default: any certificate is accepted, e.g. a self-signed one.', verbose_name=b'Verify certificate'),
+        ),
+        migrations.AddField(
+            model_name='darisserver',
+            name='ca_certificates',
+            field=models.CharField(help_text=b'Path of the PEM file of the certificate authorities trusted to verify the server certificate. Empty means the system ones.', max_length=256, verbose_name=b'CA certificates', blank=True),
+        ),
+        migrations.AddField(
+            model_name='darisserver',
+            name='ciphers',
+            field=models.CharField(help_text=b'OpenSSL cipher list for HTTPS. Empty means the defaults.', max_length=256, verbose_name=b'Ciphers', blank=True),
+        ),
+    ]
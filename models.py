@@ -2,6 +2,9 @@ from django.db import models
 
 """
   DarisServer and DarisProject models. The models are registered in admin.py.
+  TransferCheckpoint model records the progress of the transfers of experiments.
+  ManifestEntry model records the data files sent to daris projects, for incremental sync.
+  DataFileCrc model caches the CRC32 of the data files computed when they were archived.
 """
 
 
@@ -11,6 +14,36 @@ class DarisServer(models.Model):
     port = models.PositiveIntegerField('Server port', default=443)
     transport = models.CharField('Server transport', max_length=6, default='https',
                                  choices=(('https', "HTTPS"), ('http', "HTTP")))
+    stream_archive = models.BooleanField('Stream archives', default=False,
+                                         help_text='Send archives while they are being created, without '
+                                                   'temporary files.')
+    max_connections = models.PositiveIntegerField('Max concurrent connections', default=1,
+                                                  help_text='Maximum number of datasets sent in parallel to the '
+                                                            'server by a task.')
+    incremental_sync = models.BooleanField('Incremental sync', default=False,
+                                           help_text='Only send the data files that are new or have changed since '
+                                                     'the dataset was last sent to the project.')
+    compress_archive = models.BooleanField('Compress archives', default=False,
+                                           help_text='Deflate the data files which compress well. Already '
+                                                     'compressed formats are always stored.')
+    max_archive_size = models.BigIntegerField('Max archive size', default=0,
+                                              help_text='Split the datasets larger than this (in bytes) into '
+                                                        'several archives uploaded in parallel. 0 means no limit.')
+    transfer_format = models.CharField('Transfer format', max_length=8, default='zip',
+                                       choices=(('zip', 'Zip archive'), ('tar', 'Tar archive'),
+                                                ('tar.gz', 'Gzipped tar archive'),
+                                                ('tar.zst', 'Zstandard tar archive'), ('files', 'Data files')),
+                                       help_text='Send datasets as an archive, or send their data files as the '
+                                                 'attachments of one request without archiving them. Zstandard '
+                                                 'requires the zstandard package.')
+    verify_certificate = models.BooleanField('Verify certificate', default=False,
+                                             help_text='Check the certificate of the server over HTTPS. Off by '
+                                                       'default: any certificate is accepted, e.g. a self-signed one.')
+    ca_certificates = models.CharField('CA certificates', max_length=256, blank=True,
+                                       help_text='Path of the PEM file of the certificate authorities trusted to '
+                                                 'verify the server certificate. Empty means the system ones.')
+    ciphers = models.CharField('Ciphers', max_length=256, blank=True,
+                               help_text='OpenSSL cipher list for HTTPS. Empty means the defaults.')
 
     def __unicode__(self):
         return self.name + ' | ' + self.transport + '://' + self.host + ':' + str(self.port)
@@ -27,3 +60,45 @@ class DarisProject(models.Model):
             return self.server.name + '/project/' + self.cid
         else:
             return self.server.name + '/project/' + self.cid + ' - ' + self.name
+
+
+class TransferCheckpoint(models.Model):
+    """
+      Records a dataset that has been sent to a daris project as part of the transfer of an experiment, so that a
+      retried or re-submitted transfer can skip it. The checkpoints are removed once the transfer is complete.
+    """
+    project = models.ForeignKey('DarisProject', on_delete=models.CASCADE, )
+    experiment = models.ForeignKey('tardis_portal.Experiment', on_delete=models.CASCADE, )
+    dataset = models.ForeignKey('tardis_portal.Dataset', on_delete=models.CASCADE, )
+    sent_time = models.DateTimeField('Sent time', auto_now_add=True)
+
+    class Meta:
+        unique_together = ('project', 'experiment', 'dataset')
+
+
+class ManifestEntry(models.Model):
+    """
+      Records the size, modification time and checksum of a data file when it was last sent to a daris project.
+    """
+    project = models.ForeignKey('DarisProject', on_delete=models.CASCADE, )
+    dataset = models.ForeignKey('tardis_portal.Dataset', on_delete=models.CASCADE, )
+    datafile = models.ForeignKey('tardis_portal.DataFile', on_delete=models.CASCADE, )
+    size = models.BigIntegerField('Size')
+    modification_time = models.DateTimeField('Modification time', null=True, blank=True)
+    checksum = models.CharField('Checksum', max_length=128, blank=True)
+    sent_time = models.DateTimeField('Sent time', auto_now=True)
+
+    class Meta:
+        unique_together = ('project', 'datafile')
+
+
+class DataFileCrc(models.Model):
+    """
+      Caches the CRC32 of a data file, computed when it was last archived, together with the size, modification
+      time and checksum the data file had then, to detect when it is no longer valid.
+    """
+    datafile = models.OneToOneField('tardis_portal.DataFile', on_delete=models.CASCADE, )
+    size = models.BigIntegerField('Size')
+    modification_time = models.DateTimeField('Modification time', null=True, blank=True)
+    checksum = models.CharField('Checksum', max_length=128, blank=True)
+    crc32 = models.BigIntegerField('CRC32')
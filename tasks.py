@@ -1,88 +1,178 @@
 from tardis.tardis_portal.models import Experiment, Dataset, DataFile
-from .models import DarisProject
+from .models import DarisProject, TransferCheckpoint, ManifestEntry, DataFileCrc
 from celery.utils.log import get_task_logger
 from celery.task import task
+from celery import group
+from django.conf import settings
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Sum
 
 import tempfile
 from .wzipfile import WZipFile
-from zipfile import ZIP_STORED
+from .wzipfile import stored_archive_length
+from zipfile import ZIP_STORED, ZIP_DEFLATED
 import os
+import sys
+import threading
+import Queue
+import zlib
+import errno
+import hashlib
+import uuid
+import shutil
+import tarfile
+import time
+import calendar
+import io
+import collections
+import atexit
+import weakref
+from xml.sax.saxutils import escape
 
 import mfclient
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 logger = get_task_logger(__name__)
 
+# number of dataset archives to create ahead of the one being sent
+PIPELINE_DEPTH = getattr(settings, 'SEND_TO_DARIS_PIPELINE_DEPTH', 1)
+# maximum total size (in bytes) of the archives created ahead. 0 means unlimited.
+PIPELINE_DISK_BUDGET = getattr(settings, 'SEND_TO_DARIS_PIPELINE_DISK_BUDGET', 0)
+# send the datasets of an experiment as separate send_dataset tasks, so that they are spread across the workers
+FAN_OUT = getattr(settings, 'SEND_TO_DARIS_FAN_OUT', False)
+# number of threads compressing each data file of compressed archives
+DEFLATE_THREADS = getattr(settings, 'SEND_TO_DARIS_DEFLATE_THREADS', 1)
+# directory where the zip archives are kept for later sends of the same data files. None disables the cache.
+ARCHIVE_CACHE_DIR = getattr(settings, 'SEND_TO_DARIS_ARCHIVE_CACHE_DIR', None)
+# maximum total size (in bytes) of the archives in the cache
+ARCHIVE_CACHE_SIZE = getattr(settings, 'SEND_TO_DARIS_ARCHIVE_CACHE_SIZE', 10 * 1024 * 1024 * 1024)
+# age (in seconds) after which the links to the cached archives left by workers that died are removed
+ARCHIVE_CACHE_LINK_MAX_AGE = getattr(settings, 'SEND_TO_DARIS_ARCHIVE_CACHE_LINK_MAX_AGE', 24 * 3600)
+# prefix of the names of the links to the cached archives being sent
+_LINK_PREFIX = 'send_dataset_'
+# mime type, file extension and tar compression of the archive formats
+_ARCHIVE_FORMATS = {'zip': ('application/zip', '.zip', None),
+                    'tar': ('application/x-tar', '.tar', ''),
+                    'tar.gz': ('application/x-gzip', '.tar.gz', 'gz'),
+                    'tar.zst': ('application/zstd', '.tar.zst', 'zst')}
+# size of the blocks copied from the data files sent as attachments
+COPY_BUFFER_SIZE = 1024 * 1024
+# number of threads opening the data files ahead of the one being archived, for remote storage. 0 disables it.
+PREFETCH_THREADS = getattr(settings, 'SEND_TO_DARIS_PREFETCH_THREADS', 0)
+# maximum total size (in bytes) of the data files read ahead into memory
+PREFETCH_MEMORY = getattr(settings, 'SEND_TO_DARIS_PREFETCH_MEMORY', 64 * 1024 * 1024)
+# number of times the upload of an archive part is retried before the part fails
+PART_RETRIES = getattr(settings, 'SEND_TO_DARIS_PART_RETRIES', 2)
+# maximum number of idle daris connections kept logged on by a worker process for the next tasks. 0 disables it.
+CONNECTION_POOL_SIZE = getattr(settings, 'SEND_TO_DARIS_CONNECTION_POOL_SIZE', 4)
+# seconds an idle daris connection is kept in the pool before it is logged off
+CONNECTION_POOL_IDLE_TIME = getattr(settings, 'SEND_TO_DARIS_CONNECTION_POOL_IDLE_TIME', 300)
+# seconds before the expiry of its session at which a pooled connection logs on again
+_SESSION_REFRESH_MARGIN = 60
+# fields of the data files loaded from the database: the fields used to archive and send them
+_DATAFILE_FIELDS = ('id', 'dataset', 'directory', 'filename', 'size', 'modification_time', 'sha512sum', 'md5sum',
+                    'mimetype')
+
 
 @task(name='send_experiment_to_daris')
-def send_experiment(experiment_id, daris_project_id, host_addr):
+def send_experiment(experiment_id, daris_project_id, host_addr, concurrency=None, fan_out=None):
     try:
         experiment = Experiment.objects.get(pk=experiment_id)
-        datasets = Dataset.objects.filter(experiments=experiment).order_by('pk')
         daris_project = DarisProject.objects.get(pk=daris_project_id)
-        msg = 'connecting to daris'
-        logger.warning(msg)
-        send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
-        cxn = _connect_daris(daris_project)
-        logger.warning('connected to daris')
+        datasets = _unsent_datasets(experiment, daris_project)
+        if FAN_OUT if fan_out is None else fan_out:
+            return _fan_out(experiment, datasets, daris_project, host_addr)
+        concurrency = _concurrency(daris_project.server, concurrency)
+        server = daris_project.server
+        if concurrency > 1 or server.stream_archive or server.max_archive_size or server.transfer_format == 'files' \
+                or PIPELINE_DEPTH < 1:
+            _send_datasets(send_experiment, datasets, host_addr, daris_project, concurrency, async=False,
+                           experiment=experiment)
+            _complete_transfer(experiment, daris_project)
+            return
+        datasets = list(datasets)
+        cxn = None
+        failed = {}
+        pipeline = _ArchivePipeline(datasets, daris_project, PIPELINE_DEPTH, PIPELINE_DISK_BUDGET)
         try:
-            for dataset in datasets:
-                msg = 'creating zip archive for dataset ' + str(dataset.pk)
-                logger.warning(msg)
-                send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
-                temp_archive = _zip(dataset)
-                logger.warning('created zip archive for dataset ' + str(dataset.pk))
+            for i, (dataset, temp_archive, manifest, error) in enumerate(pipeline):
                 try:
-                    msg = 'sending dataset ' + str(dataset.pk) + ' to daris'
-                    logger.warning(msg)
-                    send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
-                    _send_dataset(cxn, dataset, temp_archive, host_addr, daris_project, async=False)
-                    logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
-                finally:
-                    msg = 'removing temporary file: ' + temp_archive
-                    logger.warning(msg)
-                    send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
-                    os.remove(temp_archive)
-                    logger.warning('removed temporary file: ' + temp_archive)
+                    if error is not None:
+                        raise error
+                    if temp_archive is not None:
+                        try:
+                            if cxn is None:
+                                cxn = _connect_daris(daris_project)
+                            msg = 'sending dataset ' + str(dataset.pk) + ' to daris'
+                            logger.warning(msg)
+                            send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
+                            _send_dataset(cxn, dataset, temp_archive, host_addr, daris_project, async=False)
+                            logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
+                        finally:
+                            pipeline.release(temp_archive)
+                        if manifest is not None:
+                            manifest.save()
+                    _checkpoint(experiment, daris_project, dataset)
+                    msg = 'sent dataset ' + str(dataset.pk) + ' to daris'
+                except Exception as e:
+                    logger.exception('failed to send dataset ' + str(dataset.pk) + ' to daris')
+                    failed[str(dataset.pk)] = str(e)
+                    # the connection may be broken, use a new one for the next dataset
+                    cxn = _disconnect_quietly(cxn)
+                    msg = 'failed to send dataset ' + str(dataset.pk) + ' to daris'
+                send_experiment.update_state(state='STARTED', meta={'current_activity': msg,
+                                                                    'progress': str(i + 1) + '/' + str(len(datasets)),
+                                                                    'failed': failed})
         finally:
-            logger.warning('disconnecting daris')
-            cxn.disconnect()
-            logger.warning('disconnected daris')
+            pipeline.close()
+            _release_daris(cxn)
+        if failed:
+            raise _transfer_failed(failed, [str(dataset.pk) for dataset in datasets], '%d of %d datasets to daris',
+                                   'dataset')
+        _complete_transfer(experiment, daris_project)
     except:
         raise
 
 
 @task(name='send_dataset_to_daris')
-def send_dataset(dataset_id, daris_project_id, host_addr):
+def send_dataset(dataset_id, daris_project_id, host_addr, async=True, experiment_id=None):
     try:
         dataset = Dataset.objects.get(pk=dataset_id)
         daris_project = DarisProject.objects.get(pk=daris_project_id)
-        msg = 'creating zip archive for dataset ' + str(dataset_id)
+        msg = 'connecting to daris'
         logger.warning(msg)
         send_dataset.update_state(state='STARTED', meta={'current_activity': msg})
-        temp_archive = _zip(dataset)
-        logger.warning('created zip archive for dataset ' + str(dataset_id))
+        daris = _DarisConnection(daris_project)
+        daris.get()
+        logger.warning('connected to daris')
         try:
-            msg = 'connecting to daris'
-            logger.warning(msg)
-            send_dataset.update_state(state='STARTED', meta={'current_activity': msg})
-            cxn = _connect_daris(daris_project)
-            logger.warning('connected to daris')
-            try:
-                msg = 'sending dataset ' + str(dataset.pk) + ' to daris'
-                logger.warning(msg)
-                send_dataset.update_state(state='STARTED', meta={'current_activity': msg})
-                _send_dataset(cxn, dataset, temp_archive, host_addr, daris_project, async=True)
-                logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
-            finally:
-                logger.warning('disconnecting daris')
-                cxn.disconnect()
-                logger.warning('disconnected daris')
+            _transfer_dataset(send_dataset, daris, dataset, host_addr, daris_project, async=async)
+            if experiment_id is not None:
+                # sent as part of the transfer of the experiment
+                experiment = Experiment.objects.get(pk=experiment_id)
+                _checkpoint(experiment, daris_project, dataset)
+                _complete_transfer(experiment, daris_project)
+        except:
+            daris.discard()
+            raise
         finally:
-            msg = 'removing temporary file: ' + temp_archive
-            logger.warning(msg)
-            send_dataset.update_state(state='STARTED', meta={'current_activity': msg})
-            os.remove(temp_archive)
-            logger.warning('removed temporary file: ' + temp_archive)
+            daris.release()
+    except:
+        raise
+
+
+@task(name='send_dataset_to_daris_projects')
+def send_dataset_to_projects(dataset_id, daris_project_ids, host_addr, async=True):
+    try:
+        dataset = Dataset.objects.get(pk=dataset_id)
+        daris_projects = [DarisProject.objects.get(pk=daris_project_id) for daris_project_id in daris_project_ids]
+        _send_to_projects(send_dataset_to_projects, dataset, daris_projects, host_addr, async=async)
     except:
         raise
 
@@ -99,27 +189,1042 @@ def send_datafile(datafile_id, daris_project_id, host_addr):
             logger.warning('sending datafile ' + datafile.filename + ' to daris')
             _send_datafile(cxn, datafile, host_addr, daris_project)
             logger.warning('sent datafile ' + datafile.filename + ' to daris')
+        except:
+            cxn = _disconnect_quietly(cxn)
+            raise
         finally:
-            logger.warning('disconnecting daris')
-            cxn.disconnect()
-            logger.warning('disconnected daris')
+            _release_daris(cxn)
     except:
         raise
 
 
-def _zip(dataset, func=None):
-    _, path = tempfile.mkstemp('.zip', 'send_dataset_' + str(dataset.pk) + '_to_daris_', )
-    with WZipFile(path, 'w', ZIP_STORED, allowZip64=True) as wzipfile:
-        datafiles = DataFile.objects.filter(dataset=dataset)
-        for datafile in datafiles:
-            if not func or (func and func(datafile)):
-                with datafile.file_object as file_object:
-                    arcname = os.path.join(datafile.directory if datafile.directory else '', datafile.filename)
-                    wzipfile.writeobj(file_object, datafile.size, arcname, date_time=datafile.modification_time)
+def _fan_out(experiment, datasets, daris_project, host_addr):
+    """Sends each dataset in its own send_dataset task. The tasks are dispatched as a group, whose id is
+    returned in the result so that the progress of the group can be reported as the progress of the experiment
+    task (see views.task_status).
+    """
+    dataset_ids = [dataset.pk for dataset in datasets]
+    msg = 'dispatching ' + str(len(dataset_ids)) + ' dataset tasks'
+    logger.warning(msg)
+    send_experiment.update_state(state='STARTED', meta={'current_activity': msg})
+    result = group(send_dataset.s(dataset_id, daris_project.pk, host_addr, async=False, experiment_id=experiment.pk)
+                   for dataset_id in dataset_ids).apply_async()
+    result.save()
+    return {'group_id': result.id, 'datasets': dataset_ids}
+
+
+def _unsent_datasets(experiment, daris_project):
+    """Returns the datasets of the experiment, except those already sent to the daris project by a previous
+    attempt of the transfer.
+    """
+    datasets = Dataset.objects.filter(experiments=experiment).order_by('pk')
+    sent = TransferCheckpoint.objects.filter(experiment=experiment, project=daris_project).values_list(
+        'dataset_id', flat=True)
+    if sent:
+        logger.warning('skipping ' + str(len(sent)) + ' datasets already sent to daris')
+        datasets = datasets.exclude(pk__in=sent)
+    return datasets
+
+
+def _checkpoint(experiment, daris_project, dataset):
+    TransferCheckpoint.objects.get_or_create(experiment=experiment, project=daris_project, dataset=dataset)
+
+
+def _complete_transfer(experiment, daris_project):
+    """Removes the checkpoints of the transfer once all the datasets of the experiment have been sent."""
+    checkpoints = TransferCheckpoint.objects.filter(experiment=experiment, project=daris_project)
+    if checkpoints.count() >= Dataset.objects.filter(experiments=experiment).count():
+        checkpoints.delete()
+
+
+def _concurrency(daris_server, concurrency=None):
+    """Returns the number of datasets to send in parallel: the requested concurrency capped by the limit of the
+    daris server.
+    """
+    limit = max(1, daris_server.max_connections)
+    if concurrency is None:
+        return limit
+    return max(1, min(concurrency, limit))
+
+
+def _server_semaphores(daris_projects):
+    """Returns a semaphore per daris server of the projects, by server id, bounding the number of connections
+    to the server to its max_connections (at least 1).
+    """
+    semaphores = {}
+    for daris_project in daris_projects:
+        server = daris_project.server
+        if server.pk not in semaphores:
+            semaphores[server.pk] = threading.BoundedSemaphore(_concurrency(server))
+    return semaphores
+
+
+def _send_datasets(task, datasets, host_addr, daris_project, concurrency, async=False, experiment=None):
+    """Sends the datasets to daris over concurrency worker threads (possibly one), each using its own
+    connection. A dataset that fails does not stop the others (see _run_workers). If experiment is specified, the
+    datasets sent are checkpointed as part of its transfer.
+    """
+    datasets = list(datasets)
+    # connection budget shared with the part workers of the datasets sent in parts
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def send(daris, dataset):
+        _transfer_dataset(None, daris, dataset, host_addr, daris_project, async=async, slots=slots)
+        if experiment is not None:
+            _checkpoint(experiment, daris_project, dataset)
+
+    _update_state(task, 'sending ' + str(len(datasets)) + ' datasets to daris over ' + str(concurrency) +
+                  ' connections')
+    _run_workers(task, [(str(dataset.pk), 'dataset ' + str(dataset.pk) + ' to daris', dataset) for dataset in datasets],
+                 send, concurrency, daris_project, slots=slots, what='%d of %d datasets to daris', label='dataset')
+
+
+def _send_to_projects(task, dataset, daris_projects, host_addr, async=True):
+    """Sends the dataset to several daris projects. The projects which select the same data files (see
+    _Manifest) with the same compression share one archive, created once before the uploads. The uploads run in
+    parallel, at most max_connections at a time to each daris server, each project logging on with its own token.
+    A project that fails does not stop the others (see _run_workers).
+    """
+    targets = []
+    for daris_project in daris_projects:
+        manifest = _manifest(dataset, daris_project)
+        selection = frozenset(datafile.pk for datafile in _datafiles(dataset, manifest))
+        if manifest is not None and not selection:
+            logger.warning('dataset ' + str(dataset.pk) + ' has not changed since it was last sent to daris project '
+                           + daris_project.cid)
+            continue
+        targets.append((daris_project, manifest, (daris_project.server.transfer_format,
+                                                  daris_project.server.compress_archive, selection)))
+    archives = {}
+    try:
+        for daris_project, manifest, key in targets:
+            if key[0] == 'files':
+                archives[key] = None
+            elif key not in archives:
+                _update_state(task, 'creating zip archive for dataset ' + str(dataset.pk))
+                archives[key] = _zip(dataset, manifest, key[1], key[0])
+        semaphores = _server_semaphores(daris_project for daris_project, _, _ in targets)
+
+        def upload(_, target):
+            # each upload logs on to its project, within the connections of its server
+            daris_project, manifest, key = target
+            archive = archives[key]
+            with semaphores[daris_project.server.pk]:
+                daris = _DarisConnection(daris_project)
+                try:
+                    if archive is None:
+                        datafiles = _datafiles(dataset, lambda datafile: datafile.pk in key[2])
+                        _send_datafiles(daris.get(), dataset, datafiles, host_addr, daris_project, async=async)
+                    else:
+                        _send_dataset(daris.get(), dataset, archive, host_addr, daris_project, async=async)
+                except:
+                    daris.discard()
+                    raise
+                finally:
+                    daris.release()
+            if manifest is not None:
+                manifest.save()
+
+        _update_state(task, 'sending dataset ' + str(dataset.pk) + ' to ' + str(len(targets)) + ' daris projects')
+        _run_workers(task, [(target[0].cid + ' [' + target[0].server.name + ']',
+                             'dataset ' + str(dataset.pk) + ' to daris project ' + target[0].cid, target)
+                            for target in targets],
+                     upload, len(targets), what='dataset ' + str(dataset.pk) + ' to %d of %d daris projects',
+                     label='project')
+    finally:
+        for archive in archives.values():
+            if archive is not None:
+                os.remove(archive)
+                logger.warning('removed temporary file: ' + archive)
+
+
+def _run_workers(task, items, work, concurrency, daris_project=None, slots=None, held=0, what='%d of %d items',
+                 label='item'):
+    """Processes the items on worker threads. Each item is a (key, description, value) tuple, and
+    work(daris, value) processes its value with the _DarisConnection of the worker thread (for daris_project),
+    which is kept for the next items of the worker. An item that fails does not stop the others: the connection
+    of its worker is discarded, since it may be broken, and the error is reported in the task state by key (unless
+    task is None). An ExTransferFailed is raised once all the items have been processed if any of them failed.
+
+    There are at most concurrency worker threads. With slots, the semaphore of the connections the task may use,
+    the first held threads use slots already held by the caller and the others only start if they get a free slot.
+    """
+    items = list(items)
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    results = Queue.Queue()
+
+    def worker(release_slot):
+        daris = _DarisConnection(daris_project)
+        try:
+            while True:
+                try:
+                    key, description, value = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    work(daris, value)
+                    results.put((key, description, None))
+                except Exception as e:
+                    logger.exception('failed to send ' + description)
+                    results.put((key, description, e))
+                    # the connection may be broken, use a new one for the next item
+                    daris.discard()
+        finally:
+            daris.release()
+            connection.close()
+            if release_slot:
+                slots.release()
+
+    nb_threads = min(concurrency, len(items))
+    if slots is not None:
+        acquired = 0
+        while held + acquired < nb_threads and slots.acquire(False):
+            acquired += 1
+        if held + acquired == 0 and nb_threads:
+            slots.acquire()
+            acquired = 1
+        nb_threads = held + acquired
+    threads = [threading.Thread(target=worker, args=(slots is not None and i >= held,),
+                                name='send-to-daris-worker-' + str(i))
+               for i in range(nb_threads)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    failed = {}
+    for i in range(len(items)):
+        key, description, error = results.get()
+        if error is None:
+            msg = 'sent ' + description
+        else:
+            msg = 'failed to send ' + description
+            failed[key] = str(error)
+        logger.warning(msg)
+        if task is not None:
+            task.update_state(state='STARTED', meta={'current_activity': msg,
+                                                     'progress': str(i + 1) + '/' + str(len(items)),
+                                                     'failed': failed})
+    for thread in threads:
+        thread.join()
+    if failed:
+        raise _transfer_failed(failed, [key for key, _, _ in items], what, label)
+
+
+def _transfer_failed(failed, keys, what, label):
+    """Returns the ExTransferFailed for the failed items (their error by key) among the items of the keys. what
+    describes the items sent, with the number of failed items and the total number of items, e.g. '%d of %d
+    datasets to daris'; label names each item, e.g. 'dataset'."""
+    return ExTransferFailed('Failed to send ' + what % (len(failed), len(keys)) + ': ' +
+                            ', '.join(label + ' ' + key + ' (' + failed[key] + ')' for key in keys if key in failed),
+                            failed)
+
+
+def _disconnect_quietly(cxn):
+    if cxn is not None:
+        try:
+            cxn.disconnect()
+        except Exception:
+            logger.exception('failed to disconnect daris')
+            cxn.close()
+    return None
+
+
+def _update_state(task, msg):
+    logger.warning(msg)
+    if task is not None:
+        task.update_state(state='STARTED', meta={'current_activity': msg})
+
+
+def _transfer_dataset(task, daris, dataset, host_addr, daris_project, async=True, slots=None):
+    """Sends the dataset to daris over the _DarisConnection as a zip archive, or as several archive parts if it is
+    larger than the maximum archive size of the server. The task state is updated unless task is None. slots is
+    the connection budget of the task for the server (see _send_parts).
+    """
+    manifest = _manifest(dataset, daris_project)
+    if manifest is not None and not manifest.has_changes():
+        logger.warning('dataset ' + str(dataset.pk) + ' has not changed since it was last sent to daris')
+        return
+    parts = _parts(dataset, manifest, daris_project.server.max_archive_size)
+    if len(parts) > 1:
+        # the connection goes back to the pool, where a part worker takes it, so that the task does not hold it
+        # idle on top of the connections of the parts. The next call of the caller takes one from the pool again.
+        daris.release()
+        _send_parts(task, dataset, parts, host_addr, daris_project, async=async, slots=slots)
+    else:
+        _send_archive(task, daris.get(), dataset, manifest, host_addr, daris_project, async=async)
+    if manifest is not None:
+        manifest.save()
+
+
+def _send_archive(task, cxn, dataset, func, host_addr, daris_project, async=True):
+    """Sends the data files of the dataset selected by the filter function to daris as a zip archive, or as
+    attachments if the transfer format of the server is 'files'. The archive is either streamed to the server
+    while it is being created, or created in a temporary file before being sent, depending on the server
+    settings. The task state is updated unless task is None.
+    """
+    if daris_project.server.transfer_format == 'files':
+        _update_state(task, 'sending data files of dataset ' + str(dataset.pk) + ' to daris')
+        _send_datafiles(cxn, dataset, _datafiles(dataset, func), host_addr, daris_project, async=async)
+        logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
+    elif daris_project.server.stream_archive:
+        _update_state(task, 'streaming ' + daris_project.server.transfer_format + ' archive of dataset ' +
+                      str(dataset.pk) + ' to daris')
+        _send_dataset(cxn, dataset, _zip_stream(dataset, func, daris_project.server.compress_archive,
+                                                daris_project.server.transfer_format),
+                      host_addr, daris_project, async=async)
+        logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
+    else:
+        _update_state(task, 'creating ' + daris_project.server.transfer_format + ' archive for dataset ' +
+                      str(dataset.pk))
+        temp_archive = _zip(dataset, func, daris_project.server.compress_archive, daris_project.server.transfer_format)
+        logger.warning('created archive for dataset ' + str(dataset.pk))
+        try:
+            _update_state(task, 'sending dataset ' + str(dataset.pk) + ' to daris')
+            _send_dataset(cxn, dataset, temp_archive, host_addr, daris_project, async=async)
+            logger.warning('sent dataset ' + str(dataset.pk) + ' to daris')
+        finally:
+            _update_state(task, 'removing temporary file: ' + temp_archive)
+            os.remove(temp_archive)
+            logger.warning('removed temporary file: ' + temp_archive)
+
+
+def _parts(dataset, func=None, max_size=0):
+    """Splits the data files of the dataset selected by the filter function into parts of at most max_size bytes
+    (unless a single data file is larger). The data files of a directory are kept in the same part when the
+    directory fits in one. Returns a list of sets of data file ids, or [func] if max_size is 0.
+    """
+    if not max_size:
+        return [func]
+    return _split_parts(_datafiles(dataset, func), max_size)
+
+
+def _split_parts(datafiles, max_size):
+    """Splits the data files into parts of at most max_size bytes, as described in _parts."""
+    directories = {}
+    for datafile in datafiles:
+        directories.setdefault(datafile.directory or '', []).append((datafile.pk, datafile.size))
+    parts = []
+    part = set()
+    part_size = 0
+    for directory in sorted(directories):
+        datafiles = directories[directory]
+        size = sum(datafile_size for _, datafile_size in datafiles)
+        if part and part_size + size > max_size and size <= max_size:
+            # start a new part rather than splitting the directory
+            parts.append(part)
+            part = set()
+            part_size = 0
+        for datafile_id, datafile_size in datafiles:
+            if part and part_size + datafile_size > max_size:
+                parts.append(part)
+                part = set()
+                part_size = 0
+            part.add(datafile_id)
+            part_size += datafile_size
+    if part or not parts:
+        parts.append(part)
+    return parts
+
+
+def _send_parts(task, dataset, parts, host_addr, daris_project, async=True, slots=None):
+    """Sends the archive parts of the dataset to daris in parallel, each part as a separate import over the
+    connection of its worker thread. A part that fails is retried PART_RETRIES times over a new connection, and
+    an ExTransferFailed is raised once all the parts have been processed if any of them still failed.
+
+    slots is the semaphore of the connections to the server that the task may use at the same time, the calling
+    thread holding one of them without using it (see _transfer_dataset). The first part worker uses the slot of
+    the calling thread, and the others take the free slots. Without slots, the task may use max_connections
+    connections.
+    """
+    if slots is None:
+        slots = threading.BoundedSemaphore(_concurrency(daris_project.server))
+        slots.acquire()
+
+    def send(daris, part):
+        i, datafile_ids = part
+        for attempt in range(PART_RETRIES + 1):
+            try:
+                _send_archive(None, daris.get(), dataset, lambda datafile: datafile.pk in datafile_ids, host_addr,
+                              daris_project, async=async)
+                return
+            except Exception:
+                if attempt == PART_RETRIES:
+                    raise
+                logger.exception('failed to send part ' + str(i + 1) + ' of dataset ' + str(dataset.pk) +
+                                 ' to daris (attempt ' + str(attempt + 1) + ')')
+                # the connection may be broken, use a new one for the next attempt
+                daris.discard()
+
+    _update_state(task, 'sending dataset ' + str(dataset.pk) + ' to daris in ' + str(len(parts)) + ' parts')
+    _run_workers(task, [(str(i + 1), 'part ' + str(i + 1) + ' of dataset ' + str(dataset.pk) + ' to daris', (i, part))
+                        for i, part in enumerate(parts)],
+                 send, len(parts), daris_project, slots=slots, held=1,
+                 what='%d of %d parts of dataset ' + str(dataset.pk) + ' to daris', label='part')
+
+
+def _manifest(dataset, daris_project):
+    """Returns the manifest of the data files of the dataset sent to the daris project, or None if the daris
+    server does not use incremental sync.
+    """
+    if daris_project.server.incremental_sync:
+        return _Manifest(dataset, daris_project)
+    return None
+
+
+class _Manifest(object):
+    """The state of the data files of a dataset when they were last sent to a daris project. It is used as the
+    filter function of _zip to select the data files that are new or have changed since, and remembers their
+    current state so that the manifest can be updated by save() once they are sent.
+    """
+
+    def __init__(self, dataset, daris_project):
+        self._dataset = dataset
+        self._daris_project = daris_project
+        # (size, modification time, checksum) by data file id
+        self._entries = dict((values[0], values[1:]) for values in
+                             ManifestEntry.objects.filter(dataset=dataset, project=daris_project).values_list(
+                                 'datafile_id', 'size', 'modification_time', 'checksum').iterator())
+        self._selected = {}
+
+    def __call__(self, datafile):
+        checksum = _checksum(datafile)
+        if self._entries.get(datafile.pk) == (datafile.size, datafile.modification_time, checksum):
+            return False
+        self._selected[datafile.pk] = (datafile.size, datafile.modification_time, checksum)
+        return True
+
+    def has_changes(self):
+        return any(self(datafile) for datafile in _datafiles(self._dataset))
+
+    def save(self):
+        for datafile_id, (size, modification_time, checksum) in self._selected.items():
+            ManifestEntry.objects.update_or_create(
+                project=self._daris_project, dataset=self._dataset, datafile_id=datafile_id,
+                defaults={'size': size, 'modification_time': modification_time, 'checksum': checksum})
+        self._selected = {}
+
+
+class _ArchivePipeline(object):
+    """Creates the zip archives of the datasets in a background thread, so that the next archives are ready
+    while the current one is being sent. At most depth finished archives wait for the consumer, and the total
+    size of the archives on disk is kept within disk_budget (bytes, 0 means unlimited) unless a single archive
+    exceeds it.
+
+    Iterating the pipeline yields (dataset, archive_path, manifest, error) tuples in order. The archive path is
+    None if the dataset has not changed since it was last sent (see _Manifest), or if its archive could not be
+    created, error being the exception then. The consumer must call release() for each archive once it is done
+    with it, and close() when it stops iterating.
+    """
+
+    def __init__(self, datasets, daris_project, depth=PIPELINE_DEPTH, disk_budget=PIPELINE_DISK_BUDGET):
+        self._datasets = list(datasets)
+        self._daris_project = daris_project
+        self._disk_budget = disk_budget
+        self._queue = Queue.Queue(maxsize=depth)
+        self._cond = threading.Condition()
+        self._sizes = {}
+        self._disk_usage = 0
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='send-to-daris-archive-pipeline')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reserve(self, size):
+        with self._cond:
+            while not self._closed and self._disk_usage > 0 and \
+                    0 < self._disk_budget < self._disk_usage + size:
+                self._cond.wait()
+            self._disk_usage += size
+            return not self._closed
+
+    def _unreserve(self, size):
+        with self._cond:
+            self._disk_usage -= size
+            self._cond.notify_all()
+
+    def _run(self):
+        try:
+            for dataset in self._datasets:
+                size = 0
+                try:
+                    manifest = _manifest(dataset, self._daris_project)
+                    if manifest is not None and not manifest.has_changes():
+                        logger.warning('dataset ' + str(dataset.pk) +
+                                       ' has not changed since it was last sent to daris')
+                        self._put((dataset, None, None, None))
+                        continue
+                    size = _dataset_size(dataset, manifest)
+                    if not self._reserve(size):
+                        return
+                    logger.warning('creating zip archive for dataset ' + str(dataset.pk))
+                    path = _zip(dataset, manifest, self._daris_project.server.compress_archive,
+                                self._daris_project.server.transfer_format)
+                    logger.warning('created zip archive for dataset ' + str(dataset.pk))
+                except Exception as e:
+                    logger.exception('failed to create zip archive for dataset ' + str(dataset.pk))
+                    self._unreserve(size)
+                    self._put((dataset, None, None, e))
+                    continue
+                with self._cond:
+                    self._sizes[path] = size
+                self._put((dataset, path, manifest, None))
+        except:
+            self._error = sys.exc_info()
+        finally:
+            self._put(None)
+            connection.close()
+
+    def _put(self, item):
+        while True:
+            with self._cond:
+                if self._closed:
+                    self._discard(item)
+                    return
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def _discard(self, item):
+        if item is not None and item[1] is not None:
+            self.release(item[1])
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                if self._error is not None:
+                    raise self._error[0], self._error[1], self._error[2]
+                return
+            yield item
+
+    def release(self, path):
+        logger.warning('removing temporary file: ' + path)
+        os.remove(path)
+        logger.warning('removed temporary file: ' + path)
+        with self._cond:
+            self._disk_usage -= self._sizes.pop(path, 0)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        while self._thread.is_alive() or not self._queue.empty():
+            try:
+                self._discard(self._queue.get(timeout=1))
+            except Queue.Empty:
+                pass
+        self._thread.join()
+
+
+def _dataset_size(dataset, func=None):
+    """Returns the total size of the data files in the dataset."""
+    if func:
+        return sum(datafile.size for datafile in _datafiles(dataset, func))
+    return DataFile.objects.filter(dataset=dataset).aggregate(total=Sum('size'))['total'] or 0
+
+
+def _zip(dataset, func=None, compress=False, archive_format='zip'):
+    """Creates the archive of the data files of the dataset selected by the filter function in a temporary file,
+    in one of the formats of _ARCHIVE_FORMATS. Returns the path of the temporary file.
+    """
+    if ARCHIVE_CACHE_DIR:
+        return _ArchiveCache(ARCHIVE_CACHE_DIR, ARCHIVE_CACHE_SIZE).zip(dataset, func, compress, archive_format)
+    _, path = tempfile.mkstemp(_ARCHIVE_FORMATS[archive_format][1], 'send_dataset_' + str(dataset.pk) + '_to_daris_')
+    _write_archive(path, dataset, func, compress, archive_format)
     return path
 
 
+def _write_archive(target, dataset, func=None, compress=False, archive_format='zip', crc_cache=None):
+    compression = _ARCHIVE_FORMATS[archive_format][2]
+    if compression is None:
+        _write_zip(target, dataset, func, crc_cache, compress)
+    else:
+        _write_tar(target, dataset, func, compression)
+
+
+class _ArchiveCache(object):
+    """The archives of datasets kept on disk, keyed by the content of the archive: the id, name, size,
+    modification time and checksum of the selected data files, the compression and the format. The least recently used
+    archives are evicted to keep the total size of the cache within max_size bytes.
+
+    zip() returns a hard link to the cached archive, which the caller removes after use like any temporary
+    archive. The cached archive can therefore be evicted while it is being sent. The name of the link holds its
+    creation time, so that _evict() can remove the links left by workers that died after link_max_age seconds.
+    """
+
+    def __init__(self, directory, max_size, link_max_age=ARCHIVE_CACHE_LINK_MAX_AGE):
+        self._directory = directory
+        self._max_size = max_size
+        self._link_max_age = link_max_age
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def zip(self, dataset, func=None, compress=False, archive_format='zip'):
+        extension = _ARCHIVE_FORMATS[archive_format][1]
+        cached = os.path.join(self._directory, self._key(dataset, func, compress, archive_format) + extension)
+        path = os.path.join(self._directory, _LINK_PREFIX + str(dataset.pk) + '_to_daris_' +
+                            str(int(time.time())) + '_' + uuid.uuid4().hex + extension)
+        try:
+            os.link(cached, path)
+            reused = True
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            reused = False
+        try:
+            if reused:
+                try:
+                    os.utime(cached, None)
+                except OSError as e:
+                    # ENOENT: the cached archive was evicted since, the link still holds its content
+                    if e.errno != errno.ENOENT:
+                        raise
+                logger.warning('reusing cached archive for dataset ' + str(dataset.pk))
+                return path
+            _write_archive(path, dataset, func, compress, archive_format)
+            try:
+                os.link(path, cached)
+            except OSError as e:
+                # EEXIST: the same archive was cached concurrently
+                if e.errno != errno.EEXIST:
+                    raise
+            self._evict()
+        except:
+            _remove_quietly(path)
+            raise
+        return path
+
+    @staticmethod
+    def _key(dataset, func=None, compress=False, archive_format='zip'):
+        digest = hashlib.sha1(repr((bool(compress), archive_format)))
+        for datafile in _datafiles(dataset, func):
+            digest.update(repr((datafile.pk, _arcname(datafile), datafile.size, str(datafile.modification_time),
+                                _checksum(datafile))))
+        return digest.hexdigest()
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self._directory):
+            if name.startswith(_LINK_PREFIX):
+                self._remove_stale_link(name, now)
+                continue
+            key, _, extension = name.partition('.')
+            if len(key) != 40 or '.' + extension not in [info[1] for info in _ARCHIVE_FORMATS.values()]:
+                continue
+            try:
+                st = os.stat(os.path.join(self._directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(os.path.join(self._directory, name))
+                logger.warning('evicted archive from the cache: ' + name)
+            except OSError:
+                pass
+            total -= size
+
+    def _remove_stale_link(self, name, now):
+        """Removes the link to a cached archive if it is older than link_max_age. The links of the current sends
+        are removed by their callers."""
+        try:
+            created = int(name.partition('.')[0].rsplit('_', 2)[-2])
+        except (IndexError, ValueError):
+            return
+        if now - created > self._link_max_age and _remove_quietly(os.path.join(self._directory, name)):
+            logger.warning('removed stale link from the archive cache: ' + name)
+
+
+def _remove_quietly(path):
+    """Removes the file if it exists. Returns whether it was removed."""
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+def _zip_stream(dataset, func=None, compress=False, archive_format='zip'):
+    """Returns a service input which writes the archive of the dataset directly to the request. The exact
+    length of a stored zip archive or of an uncompressed tar archive is computed in advance, so the request is
+    sent with a Content-Length header. A compressed archive is sent with chunked transfer encoding.
+    """
+    mime_type, _, compression = _ARCHIVE_FORMATS[archive_format]
+    crc_cache = None
+    if compression is None:
+        crc_cache = _CrcCache(dataset)
+        if compress:
+            length = -1
+        else:
+            length = stored_archive_length(((_arcname(datafile), datafile.size, crc_cache.get(datafile))
+                                            for datafile in _datafiles(dataset, func)), data_descriptor=True)
+    elif not compression:
+        length = _tar_length(_datafiles(dataset, func))
+    else:
+        length = -1
+    return mfclient.MFStreamInput(lambda fp: _write_archive(fp, dataset, func, compress, archive_format, crc_cache),
+                                  mime_type, length)
+
+
+def _write_zip(target, dataset, func=None, crc_cache=None, compress=False):
+    if crc_cache is None:
+        crc_cache = _CrcCache(dataset)
+    with WZipFile(target, 'w', ZIP_STORED, allowZip64=True, deflate_threads=DEFLATE_THREADS) as wzipfile:
+        for datafile, file_object in _prefetched(_datafiles(dataset, func)):
+            with file_object:
+                crc = crc_cache.get(datafile)
+                compress_type = ZIP_STORED
+                if compress:
+                    compress_type, file_object = _compress_type(datafile, file_object)
+                zinfo = wzipfile.writeobj(file_object, datafile.size, _arcname(datafile),
+                                          compress_type=compress_type, date_time=datafile.modification_time,
+                                          crc=crc)
+                if crc is None:
+                    crc_cache.put(datafile, zinfo.CRC)
+    crc_cache.save()
+
+
+def _write_tar(target, dataset, func=None, compression=''):
+    """Writes the tar archive of the data files of the dataset selected by the filter function to target, a path
+    or a file object. The archive is written as a stream: unlike a zip archive, it needs no seek and no index at
+    the end. compression is '' (none), 'gz' or 'zst'.
+    """
+    fp = open(target, 'wb') if isinstance(target, basestring) else target
+    try:
+        writer = fp
+        if compression == 'zst':
+            if zstandard is None:
+                raise ExArchiveFormat('The tar.zst archive format requires the zstandard package.')
+            writer = zstandard.ZstdCompressor().stream_writer(fp)
+            compression = ''
+        tar = tarfile.open(fileobj=writer, mode='w|' + compression)
+        for datafile, file_object in _prefetched(_datafiles(dataset, func)):
+            with file_object:
+                tar.addfile(_tarinfo(datafile), file_object)
+            # the members are only needed to read the archive
+            del tar.members[:]
+        tar.close()
+        if writer is not fp:
+            writer.flush(zstandard.FLUSH_FRAME)
+    finally:
+        if fp is not target:
+            fp.close()
+
+
+def _tarinfo(datafile):
+    arcname = _arcname(datafile)
+    # the name is written in UTF-8, whatever the file system encoding used by tarfile for unicode names
+    tarinfo = tarfile.TarInfo(arcname.encode('utf-8') if isinstance(arcname, unicode) else arcname)
+    tarinfo.size = datafile.size
+    tarinfo.mode = 0o600
+    modification_time = datafile.modification_time
+    if modification_time is not None:
+        if getattr(modification_time, 'tzinfo', None) is not None:
+            tarinfo.mtime = calendar.timegm(modification_time.utctimetuple())
+        else:
+            # naive times are taken as local times
+            if hasattr(modification_time, 'timetuple'):
+                modification_time = modification_time.timetuple()
+            tarinfo.mtime = int(time.mktime(tuple(modification_time[:6]) + (0, 0, -1)))
+    return tarinfo
+
+
+def _tar_length(datafiles):
+    """Returns the exact length of the uncompressed tar archive of the data files, as written by _write_tar."""
+    length = 0
+    for datafile in datafiles:
+        length += len(_tarinfo(datafile).tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'strict'))
+        length += -(-datafile.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    # two zero blocks, padded to a whole record
+    length += 2 * tarfile.BLOCKSIZE
+    return -(-length // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+# extensions of the formats which are already compressed
+_COMPRESSED_EXTENSIONS = frozenset(['.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz', '.lz4', '.zst', '.zip', '.7z',
+                                    '.rar', '.jar', '.jpg', '.jpeg', '.jp2', '.png', '.gif', '.webp', '.mp3', '.mp4',
+                                    '.m4a', '.m4v', '.mov', '.avi', '.mkv', '.webm', '.ogg', '.flac', '.pdf'])
+# mime types of the formats which are already compressed, besides the image, audio and video types
+_COMPRESSED_MIME_TYPES = frozenset(['application/gzip', 'application/x-gzip', 'application/x-bzip2',
+                                    'application/x-xz', 'application/zstd', 'application/zip',
+                                    'application/x-7z-compressed', 'application/x-rar-compressed',
+                                    'application/java-archive', 'application/pdf'])
+# image types which are usually not compressed
+_UNCOMPRESSED_IMAGE_TYPES = frozenset(['image/tiff', 'image/bmp', 'image/x-ms-bmp', 'image/x-portable-pixmap',
+                                       'image/x-portable-graymap', 'image/fits'])
+# DICOM transfer syntaxes of uncompressed pixel data: implicit VR little endian, explicit VR little endian,
+# explicit VR big endian
+_DICOM_UNCOMPRESSED_SYNTAXES = frozenset(['1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.2'])
+# data files smaller than this are stored
+_COMPRESS_MIN_SIZE = 1024
+# size of the first block of a data file compressed to estimate how well the data file compresses
+_COMPRESS_TRIAL_SIZE = 64 * 1024
+# a data file is deflated only if the trial compression is below this ratio
+_COMPRESS_MAX_RATIO = 0.9
+
+
+def _compress_type(datafile, file_object):
+    """Decides whether the data file is stored or deflated. Already compressed formats are recognised by their
+    extension, mime type or, for DICOM files, transfer syntax, and always stored. Other data files are deflated if
+    their first block compresses well. Returns the compression type and the file object to read the data file
+    from, positioned at its start.
+    """
+    if datafile.size < _COMPRESS_MIN_SIZE:
+        return ZIP_STORED, file_object
+    if os.path.splitext(datafile.filename)[1].lower() in _COMPRESSED_EXTENSIONS:
+        return ZIP_STORED, file_object
+    mimetype = (getattr(datafile, 'mimetype', None) or '').split(';')[0].strip().lower()
+    if mimetype in _COMPRESSED_MIME_TYPES or (mimetype.split('/')[0] in ('image', 'audio', 'video') and
+                                              mimetype not in _UNCOMPRESSED_IMAGE_TYPES):
+        return ZIP_STORED, file_object
+    head = file_object.read(_COMPRESS_TRIAL_SIZE)
+    try:
+        file_object.seek(0)
+    except (AttributeError, IOError, OSError):
+        file_object = _HeadReader(head, file_object)
+    if _dicom_compressed(head):
+        return ZIP_STORED, file_object
+    if len(zlib.compress(head, 1)) > len(head) * _COMPRESS_MAX_RATIO:
+        return ZIP_STORED, file_object
+    return ZIP_DEFLATED, file_object
+
+
+def _dicom_compressed(head):
+    """Returns True if head is the start of a DICOM part 10 file with compressed pixel data."""
+    if len(head) < 132 or head[128:132] != 'DICM':
+        return False
+    # the file meta information is encoded in explicit VR little endian
+    index = head.find('\x02\x00\x10\x00UI', 132)
+    if index < 0 or index + 8 > len(head):
+        return False
+    length = ord(head[index + 6]) | ord(head[index + 7]) << 8
+    if index + 8 + length > len(head):
+        return False
+    syntax = head[index + 8:index + 8 + length].rstrip('\x00 ')
+    return syntax not in _DICOM_UNCOMPRESSED_SYNTAXES
+
+
+class _HeadReader(object):
+    """Reads the block already read from the start of a file object which cannot seek, then the rest of it."""
+
+    def __init__(self, head, file_object):
+        self._head = head
+        self._file_object = file_object
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._file_object.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._file_object.read(), ''
+        else:
+            data, self._head = self._head[:size], self._head[size:]
+        return data
+
+
+def _datafiles(dataset, func=None):
+    """Yields the data files of the dataset selected by the filter function, in a stable order. The data files are
+    streamed from the database with only the fields used here, rather than cached by the queryset.
+    """
+    for datafile in DataFile.objects.filter(dataset=dataset).only(*_DATAFILE_FIELDS).order_by('pk').iterator():
+        if not func or func(datafile):
+            yield datafile
+
+
+def _prefetched(datafiles):
+    """Yields (datafile, file_object) for the data files, in order. The file objects are opened ahead by a
+    _Prefetcher if PREFETCH_THREADS is set, or when they are reached otherwise. The consumer closes them.
+    """
+    if PREFETCH_THREADS < 1:
+        return ((datafile, datafile.file_object) for datafile in datafiles)
+    return iter(_Prefetcher(datafiles, PREFETCH_THREADS, PREFETCH_MEMORY))
+
+
+class _Prefetcher(object):
+    """Opens the data files ahead of the consumer in worker threads, so that the round trips to remote storage
+    overlap with the archiving of the current data file. At most two data files per thread are opened ahead. The
+    data files which fit in the remaining memory budget are read into memory, the others are only opened.
+
+    Iterating the prefetcher yields (datafile, file_object) in the order of the data files. The consumer must
+    close each file object; the file objects opened ahead but not consumed are closed when iteration stops.
+    """
+
+    def __init__(self, datafiles, threads, memory_budget):
+        self._datafiles = iter(datafiles)
+        self._threads = threads
+        self._memory_budget = memory_budget
+        self._memory = 0
+        self._jobs = Queue.Queue()
+        self._pending = collections.deque()
+
+    def __iter__(self):
+        workers = [threading.Thread(target=self._run, name='send-to-daris-prefetch-' + str(i))
+                   for i in range(self._threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            while True:
+                self._fill()
+                if not self._pending:
+                    return
+                datafile, size, result = self._pending.popleft()
+                file_object, exc_info = result.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield datafile, file_object
+                self._memory -= size
+        finally:
+            for _ in workers:
+                self._jobs.put(None)
+            while self._pending:
+                _, _, result = self._pending.popleft()
+                file_object, _ = result.get()
+                if file_object is not None:
+                    file_object.close()
+            for worker in workers:
+                worker.join()
+
+    def _fill(self):
+        while len(self._pending) < 2 * self._threads:
+            try:
+                datafile = next(self._datafiles)
+            except StopIteration:
+                return
+            size = datafile.size if self._memory + datafile.size <= self._memory_budget else 0
+            self._memory += size
+            result = Queue.Queue(maxsize=1)
+            self._pending.append((datafile, size, result))
+            self._jobs.put((datafile, size > 0, result))
+
+    def _run(self):
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                datafile, buffered, result = job
+                try:
+                    file_object = datafile.file_object
+                    if buffered:
+                        with file_object as source:
+                            file_object = io.BytesIO(source.read())
+                    result.put((file_object, None))
+                except:
+                    result.put((None, sys.exc_info()))
+        finally:
+            connection.close()
+
+
+def _arcname(datafile):
+    return os.path.join(datafile.directory if datafile.directory else '', datafile.filename)
+
+
+def _checksum(datafile):
+    return datafile.sha512sum or datafile.md5sum or ''
+
+
+class _CrcCache(object):
+    """The CRC32 of the data files of a dataset computed by previous sends. A cached CRC32 is valid as long as the
+    data file has the same size and checksum, or the same size and modification time if it has no checksum. The
+    data files with neither are not cached, since a change which keeps their size could not be detected.
+    """
+
+    def __init__(self, dataset):
+        # (size, modification time, checksum, crc32) by data file id
+        self._entries = dict((values[0], values[1:]) for values in
+                             DataFileCrc.objects.filter(datafile__dataset=dataset).values_list(
+                                 'datafile_id', 'size', 'modification_time', 'checksum', 'crc32').iterator())
+        self._computed = {}
+
+    @staticmethod
+    def _cacheable(datafile):
+        return bool(_checksum(datafile)) or datafile.modification_time is not None
+
+    def get(self, datafile):
+        entry = self._entries.get(datafile.pk)
+        if entry is None or not self._cacheable(datafile):
+            return None
+        size, modification_time, checksum, crc = entry
+        if size != datafile.size or checksum != _checksum(datafile):
+            return None
+        if not checksum and modification_time != datafile.modification_time:
+            return None
+        return crc
+
+    def put(self, datafile, crc):
+        if not self._cacheable(datafile):
+            return
+        self._computed[datafile.pk] = (datafile.size, datafile.modification_time, _checksum(datafile), crc)
+
+    def save(self):
+        if not self._computed:
+            return
+        try:
+            with transaction.atomic():
+                DataFileCrc.objects.filter(datafile_id__in=list(self._computed)).delete()
+                DataFileCrc.objects.bulk_create([
+                    DataFileCrc(datafile_id=datafile_id, size=size, modification_time=modification_time,
+                                checksum=checksum, crc32=crc)
+                    for datafile_id, (size, modification_time, checksum, crc) in self._computed.items()])
+        except IntegrityError:
+            # saved concurrently by another task
+            logger.warning('failed to save the crc32 of ' + str(len(self._computed)) + ' data files')
+        self._computed = {}
+
+
 def _send_dataset(cxn, dataset, archive, host_addr, daris_project, async=True, dicom_ingest=True):
+    w = _import_args(dataset, host_addr, daris_project, async, dicom_ingest)
+    if isinstance(archive, mfclient.MFStreamInput):
+        input1 = archive
+    else:
+        input1 = mfclient.MFInput(archive, _archive_mime_type(archive))
+    cxn.execute('daris.mytardis.dataset.import', w.doc_text(), [input1])
+
+
+def _archive_mime_type(path):
+    for mime_type, extension, _ in _ARCHIVE_FORMATS.values():
+        if path.endswith(extension):
+            return mime_type
+    return 'application/zip'
+
+
+def _send_datafiles(cxn, dataset, datafiles, host_addr, daris_project, async=True, dicom_ingest=True):
+    """Sends the data files to daris as the consecutive attachments of one dataset import, without archiving
+    them. The datafile elements of the arguments give the relative path and size of each attachment, in the same
+    order. Each data file is opened only when its attachment is sent.
+    """
+    w = _import_args(dataset, host_addr, daris_project, async, dicom_ingest)
+    inputs = []
+    for datafile in datafiles:
+        w.push('datafile')
+        w.add('path', escape(_arcname(datafile)))
+        w.add('size', datafile.size)
+        w.pop()
+        inputs.append(mfclient.MFStreamInput(_datafile_producer(datafile), getattr(datafile, 'mimetype', None) or None,
+                                             datafile.size))
+    cxn.execute('daris.mytardis.dataset.import', w.doc_text(), inputs)
+
+
+def _datafile_producer(datafile):
+    def produce(fp):
+        with datafile.file_object as file_object:
+            shutil.copyfileobj(file_object, fp, COPY_BUFFER_SIZE)
+    return produce
+
+
+def _import_args(dataset, host_addr, daris_project, async=True, dicom_ingest=True):
     experiment = dataset.get_first_experiment()
     w = mfclient.XmlStringWriter('args')
     w.push('experiment')
@@ -140,17 +1245,164 @@ def _send_dataset(cxn, dataset, archive, host_addr, daris_project, async=True, d
     w.add('project', daris_project.cid)
     w.add("dicom-ingest", dicom_ingest)
     w.add("async", async)
-    input1 = mfclient.MFInput(archive, 'application/zip')
-    cxn.execute('daris.mytardis.dataset.import', w.doc_text(), [input1])
+    return w
 
 
 def _send_datafile(cxn, datafile, host_addr, daris_project):
-    raise NotImplementedError(
-        'Sending individual data file to DaRIS has not yet been implemented. Nor is enabled in MyTardis portal.')
+    _send_datafiles(cxn, datafile.dataset, [datafile], host_addr, daris_project)
 
 
 def _connect_daris(daris_project):
-    daris_server = daris_project.server
-    cxn = mfclient.MFConnection(daris_server.host, daris_server.port, daris_server.transport.lower() == 'https')
-    cxn.connect(token=daris_project.token)
-    return cxn
+    """Returns a connection logged on to the daris server with the token of the project, taken from the pool of
+    the worker process if one is idle there. It is released by _release_daris, or by _disconnect_quietly if it
+    may be broken.
+    """
+    return _CONNECTION_POOL.acquire(daris_project)
+
+
+def _release_daris(cxn):
+    if cxn is not None:
+        _CONNECTION_POOL.release(cxn)
+
+
+class _DarisConnection(object):
+    """The connection of a worker to the daris project, taken from the pool when it is first needed. release()
+    returns it to the pool and discard() logs it off if it may be broken; either way, the next get() takes a
+    connection again.
+    """
+
+    def __init__(self, daris_project):
+        self._daris_project = daris_project
+        self._cxn = None
+
+    def get(self):
+        if self._cxn is None:
+            self._cxn = _connect_daris(self._daris_project)
+        return self._cxn
+
+    def release(self):
+        _release_daris(self._cxn)
+        self._cxn = None
+
+    def discard(self):
+        self._cxn = _disconnect_quietly(self._cxn)
+
+
+class _ConnectionPool(object):
+    """The idle daris connections of the worker process, logged on and kept for the next tasks, keyed by the
+    server and the token they logged on with. At most max_size connections are kept, the least recently released
+    are logged off first. A connection idle for more than max_idle seconds is logged off, and one whose session
+    is about to expire logs on again before it is reused.
+    """
+
+    def __init__(self, max_size, max_idle):
+        self._max_size = max_size
+        self._max_idle = max_idle
+        self._lock = threading.Lock()
+        # (key, connection, release time), least recently released first
+        self._idle = []
+        # the keys of the connections in use
+        self._keys = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _key(daris_project):
+        daris_server = daris_project.server
+        return daris_server.host, daris_server.port, daris_server.transport.lower(), daris_project.token
+
+    def acquire(self, daris_project):
+        key = self._key(daris_project)
+        cxn = None
+        with self._lock:
+            expired = self._evict()
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == key:
+                    cxn = self._idle.pop(i)[1]
+                    break
+        for idle_cxn in expired:
+            _disconnect_quietly(idle_cxn)
+        if cxn is not None:
+            expiry = cxn.session_expiry
+            if expiry is not None and expiry - time.time() <= _SESSION_REFRESH_MARGIN:
+                logger.warning('refreshing daris session')
+                _disconnect_quietly(cxn)
+                try:
+                    cxn.connect(token=daris_project.token)
+                except:
+                    cxn.close()
+                    raise
+        else:
+            daris_server = daris_project.server
+            encrypt = daris_server.transport.lower() == 'https'
+            cxn = mfclient.MFConnection(daris_server.host, daris_server.port, encrypt,
+                                        ssl_context=_ssl_context(daris_server) if encrypt else None)
+            cxn.connect(token=daris_project.token)
+        with self._lock:
+            self._keys[cxn] = key
+        return cxn
+
+    def release(self, cxn):
+        with self._lock:
+            key = self._keys.pop(cxn, None)
+        if key is None or self._max_size < 1 or not cxn.session:
+            _disconnect_quietly(cxn)
+            return
+        with self._lock:
+            self._idle.append((key, cxn, time.time()))
+            expired = self._evict()
+        for idle_cxn in expired:
+            _disconnect_quietly(idle_cxn)
+
+    def clear(self):
+        with self._lock:
+            expired = [cxn for _, cxn, _ in self._idle]
+            self._idle = []
+        for idle_cxn in expired:
+            _disconnect_quietly(idle_cxn)
+
+    def _evict(self):
+        """Removes the connections idle for too long, and the least recently released over max_size. Returns
+        them, to be logged off outside of the lock."""
+        now = time.time()
+        expired = [cxn for _, cxn, released in self._idle if now - released > self._max_idle]
+        kept = [item for item in self._idle if now - item[2] <= self._max_idle]
+        excess = max(0, len(kept) - self._max_size)
+        expired.extend(cxn for _, cxn, _ in kept[:excess])
+        self._idle = kept[excess:]
+        return expired
+
+
+def _ssl_context(daris_server):
+    """Returns the ssl context of the worker process for the daris server, shared by its connections so that the
+    certificates and cipher list are loaded once."""
+    key = (daris_server.host, daris_server.port, daris_server.verify_certificate, daris_server.ca_certificates,
+           daris_server.ciphers)
+    with _SSL_CONTEXTS_LOCK:
+        context = _SSL_CONTEXTS.get(key)
+        if context is None:
+            context = mfclient.create_ssl_context(daris_server.verify_certificate,
+                                                  daris_server.ca_certificates or None, daris_server.ciphers or None)
+            _SSL_CONTEXTS[key] = context
+        return context
+
+
+_SSL_CONTEXTS = {}
+_SSL_CONTEXTS_LOCK = threading.Lock()
+_CONNECTION_POOL = _ConnectionPool(CONNECTION_POOL_SIZE, CONNECTION_POOL_IDLE_TIME)
+# log off the idle connections when the worker process exits
+atexit.register(_CONNECTION_POOL.clear)
+
+
+class ExTransferFailed(Exception):
+    """Some of the datasets, projects or parts of a transfer failed. errors holds the error of each of them by key
+    (see _run_workers)."""
+
+    def __init__(self, message, errors):
+        super(ExTransferFailed, self).__init__(message, errors)
+        self.errors = errors
+
+    def __str__(self):
+        return self.args[0]
+
+
+class ExArchiveFormat(Exception):
+    pass
@@ -1,3 +1,649 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+import shutil
+import socket
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
-# Create your tests here.
+from unittest import skipIf
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from . import mfclient
+from .mfclient import XmlStringWriter
+from .models import DarisServer, DarisProject
+from .tasks import ExTransferFailed, _ArchiveCache, _ConnectionPool, _CrcCache, _compress_type, _concurrency, \
+    _dicom_compressed, _run_workers, _server_semaphores, _split_parts, _tar_length, _tarinfo
+from .wzipfile import WZipFile, DEFLATE_BLOCK_SIZE, _Crc32Combiner, stored_archive_length
+
+# the attributes of a DataFile read when archiving it
+DataFile = namedtuple('DataFile', ['directory', 'filename', 'size', 'modification_time'])
+# the attributes of a DataFile which tell whether it has changed
+StoredDataFile = namedtuple('StoredDataFile', ['pk', 'size', 'modification_time', 'sha512sum', 'md5sum'])
+# the attributes of a DataFile which decide its archive part
+PartDataFile = namedtuple('PartDataFile', ['pk', 'directory', 'size'])
+# the attributes of a DataFile which decide whether it is deflated
+TypedDataFile = namedtuple('TypedDataFile', ['filename', 'size', 'mimetype'])
+
+
+def dicom(syntax):
+    """Returns the start of a DICOM part 10 file with the transfer syntax."""
+    syntax += '\x00' * (len(syntax) % 2)
+    return '\x00' * 128 + 'DICM' + '\x02\x00\x10\x00UI' + struct.pack('<H', len(syntax)) + syntax + '\x00' * 2000
+
+
+class Stream(object):
+    """Non-seekable output, like a socket or an http request body."""
+
+    def __init__(self):
+        self.output = io.BytesIO()
+
+    def write(self, data):
+        self.output.write(data)
+
+    def flush(self):
+        pass
+
+
+class Crc32CombinerTest(SimpleTestCase):
+
+    def test_combined_crc(self):
+        data = os.urandom(3 * DEFLATE_BLOCK_SIZE + 12345)
+        combiner = _Crc32Combiner()
+        for position in range(0, len(data), DEFLATE_BLOCK_SIZE):
+            block = data[position:position + DEFLATE_BLOCK_SIZE]
+            combiner.update(zlib.crc32(block) & 0xffffffff, len(block))
+        self.assertEqual(combiner.crc, zlib.crc32(data) & 0xffffffff)
+
+    def test_parallel_deflate(self):
+        data = os.urandom(1024) * (3 * DEFLATE_BLOCK_SIZE // 1024) + os.urandom(777)
+        output = io.BytesIO()
+        with WZipFile(output, 'w', ZIP_DEFLATED, deflate_threads=4) as wzipfile:
+            zinfo = wzipfile.writeobj(io.BytesIO(data), len(data), 'data.bin')
+        self.assertEqual(zinfo.CRC, zlib.crc32(data) & 0xffffffff)
+        archive = ZipFile(io.BytesIO(output.getvalue()))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('data.bin'), data)
+
+    def test_parallel_deflate_threads(self):
+        # archives compressed in parallel by several threads at once, as by the dataset and part workers
+        errors = []
+
+        def write(tail):
+            data = os.urandom(2 * DEFLATE_BLOCK_SIZE + tail)
+            with WZipFile(io.BytesIO(), 'w', ZIP_DEFLATED, deflate_threads=2) as wzipfile:
+                zinfo = wzipfile.writeobj(io.BytesIO(data), len(data), 'data.bin')
+            if zinfo.CRC != zlib.crc32(data) & 0xffffffff:
+                errors.append(tail)
+
+        threads = [threading.Thread(target=write, args=(tail,)) for tail in range(1, 4097, 512)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class WZipFileTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_keeps_mode_in_data_descriptor_mode(self):
+        path = os.path.join(self.directory, 'run.sh')
+        with open(path, 'wb') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(path, 0o755)
+        output = io.BytesIO()
+        with WZipFile(output, 'w', data_descriptor=True) as wzipfile:
+            wzipfile.write(path, 'run.sh')
+        zinfo = ZipFile(io.BytesIO(output.getvalue())).getinfo('run.sh')
+        self.assertEqual(stat.S_IMODE(zinfo.external_attr >> 16), 0o755)
+
+    def test_stream(self):
+        entries = [('a.bin', os.urandom(1000)), ('dir/b.bin', os.urandom(70000)), ('empty', '')]
+        stream = Stream()
+        with WZipFile(stream, 'w') as wzipfile:
+            self.assertTrue(wzipfile.data_descriptor)
+            for arcname, data in entries:
+                zinfo = wzipfile.writeobj(io.BytesIO(data), len(data), arcname)
+                self.assertTrue(zinfo.flag_bits & 0x08)
+        archive = ZipFile(io.BytesIO(stream.output.getvalue()))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual([(zinfo.filename, archive.read(zinfo)) for zinfo in archive.infolist()], entries)
+
+    def test_stored_archive_length(self):
+        entries = [('a.bin', os.urandom(1000), None), ('dir/b.bin', os.urandom(70000), None), ('empty', '', None),
+                   (u'déjà/vu.txt', 'vu', None)]
+        # CRC known in advance for some entries: their final header is written at once
+        entries.append(('known_crc.bin', 'x' * 5000, zlib.crc32('x' * 5000) & 0xffffffff))
+        for data_descriptor in (True, False):
+            output = Stream() if data_descriptor else io.BytesIO()
+            with WZipFile(output, 'w', data_descriptor=data_descriptor) as wzipfile:
+                for arcname, data, crc in entries:
+                    wzipfile.writeobj(io.BytesIO(data), len(data), arcname, crc=crc)
+            data = output.output.getvalue() if data_descriptor else output.getvalue()
+            length = stored_archive_length(((arcname, len(data), crc) for arcname, data, crc in entries),
+                                           data_descriptor=data_descriptor)
+            self.assertEqual(length, len(data))
+            self.assertIsNone(ZipFile(io.BytesIO(data)).testzip())
+
+    def test_writeobj_from_file_position(self):
+        path = os.path.join(self.directory, 'data.bin')
+        data = os.urandom(3 * 1024 * 1024 + 5)
+        with open(path, 'wb') as f:
+            f.write(data)
+        output = io.BytesIO()
+        with open(path, 'rb') as f, WZipFile(output, 'w') as wzipfile:
+            f.read(100)
+            zinfo = wzipfile.writeobj(f, len(data) - 100, 'data.bin')
+        self.assertEqual(zinfo.CRC, zlib.crc32(data[100:]) & 0xffffffff)
+        archive = ZipFile(io.BytesIO(output.getvalue()))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('data.bin'), data[100:])
+
+
+class ArchiveCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_evict_removes_stale_links(self):
+        cached = os.path.join(self.directory, 'a' * 40 + '.zip')
+        with open(cached, 'wb') as f:
+            f.write('archive')
+        now = int(time.time())
+        stale = 'send_dataset_1_to_daris_' + str(now - 7200) + '_' + 'b' * 32 + '.zip'
+        current = 'send_dataset_1_to_daris_' + str(now) + '_' + 'c' * 32 + '.zip'
+        for name in (stale, current):
+            os.link(cached, os.path.join(self.directory, name))
+        _ArchiveCache(self.directory, 1024, link_max_age=3600)._evict()
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(['a' * 40 + '.zip', current]))
+
+
+class TarTest(SimpleTestCase):
+
+    def test_tar_length(self):
+        # a long name (GNU longname header), a unicode name, and sizes which are not multiples of the block size
+        datafiles = [DataFile('', 'a', 0, None), DataFile('dir', 'b', 511, None), DataFile('dir', 'c', 512, None),
+                     DataFile('x' * 90, 'y' * 90, 10000, datetime(2020, 1, 2, 3, 4, 5)),
+                     DataFile(u'déjà', u'vu', 1, None)]
+        for count in (1, len(datafiles), 30):
+            selected = (datafiles * 6)[:count]
+            output = io.BytesIO()
+            tar = tarfile.open(fileobj=output, mode='w|')
+            for datafile in selected:
+                tar.addfile(_tarinfo(datafile), io.BytesIO('z' * datafile.size))
+            tar.close()
+            self.assertEqual(_tar_length(selected), len(output.getvalue()))
+
+    def test_tarinfo_aware_time(self):
+        modification_time = datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        self.assertEqual(_tarinfo(DataFile('', 'a', 1, modification_time)).mtime, 1577934245)
+        modification_time = timezone.make_aware(datetime(2020, 1, 2, 13, 4, 5), timezone.get_fixed_timezone(600))
+        self.assertEqual(_tarinfo(DataFile('', 'a', 1, modification_time)).mtime, 1577934245)
+
+
+class CrcCacheTest(SimpleTestCase):
+
+    @staticmethod
+    def crc_cache(*datafiles):
+        crc_cache = _CrcCache.__new__(_CrcCache)
+        crc_cache._entries = dict((datafile.pk, (datafile.size, datafile.modification_time,
+                                                 datafile.sha512sum or datafile.md5sum or '', 123))
+                                  for datafile in datafiles)
+        crc_cache._computed = {}
+        return crc_cache
+
+    def test_checksum_or_modification_time(self):
+        modification_time = datetime(2020, 1, 2, 3, 4, 5)
+        with_checksum = StoredDataFile(1, 10, None, '', 'abc')
+        with_time = StoredDataFile(2, 10, modification_time, '', '')
+        crc_cache = self.crc_cache(with_checksum, with_time)
+        self.assertEqual(crc_cache.get(with_checksum), 123)
+        self.assertEqual(crc_cache.get(with_time), 123)
+        self.assertIsNone(crc_cache.get(with_checksum._replace(md5sum='abd')))
+        self.assertIsNone(crc_cache.get(with_time._replace(modification_time=datetime(2021, 1, 1))))
+
+    def test_neither_checksum_nor_modification_time(self):
+        datafile = StoredDataFile(1, 10, None, '', '')
+        crc_cache = self.crc_cache(datafile)
+        self.assertIsNone(crc_cache.get(datafile))
+        crc_cache.put(datafile, 456)
+        self.assertEqual(crc_cache._computed, {})
+
+
+class PartsTest(SimpleTestCase):
+
+    def test_max_size_boundaries(self):
+        datafiles = [PartDataFile(1, 'a', 40), PartDataFile(2, 'a', 60), PartDataFile(3, 'b', 100),
+                     PartDataFile(4, 'c', 1)]
+        # a part may be exactly max_size bytes
+        self.assertEqual(_split_parts(datafiles, 100), [{1, 2}, {3}, {4}])
+        self.assertEqual(_split_parts(datafiles, 101), [{1, 2}, {3, 4}])
+        self.assertEqual(_split_parts(datafiles, 1000), [{1, 2, 3, 4}])
+
+    def test_directory_kept_together(self):
+        datafiles = [PartDataFile(1, 'a', 30), PartDataFile(2, 'b', 40), PartDataFile(3, 'b', 40)]
+        # the directory b does not fit after a, but fits in a part of its own
+        self.assertEqual(_split_parts(datafiles, 100), [{1}, {2, 3}])
+        # the directory b is split when it does not fit in any part
+        self.assertEqual(_split_parts(datafiles, 60), [{1}, {2}, {3}])
+
+    def test_data_file_larger_than_max_size(self):
+        datafiles = [PartDataFile(1, '', 10), PartDataFile(2, '', 500), PartDataFile(3, '', 10)]
+        self.assertEqual(_split_parts(datafiles, 100), [{1}, {2}, {3}])
+        self.assertEqual(_split_parts([PartDataFile(1, '', 500)], 100), [{1}])
+
+    def test_no_data_files(self):
+        self.assertEqual(_split_parts([], 100), [set()])
+
+
+class CompressTypeTest(SimpleTestCase):
+
+    def compress_type(self, filename, data, mimetype=None):
+        return _compress_type(TypedDataFile(filename, len(data), mimetype), io.BytesIO(data))[0]
+
+    def test_dicom_transfer_syntax(self):
+        self.assertFalse(_dicom_compressed(dicom('1.2.840.10008.1.2')))
+        self.assertFalse(_dicom_compressed(dicom('1.2.840.10008.1.2.1')))
+        # JPEG baseline and JPEG 2000
+        self.assertTrue(_dicom_compressed(dicom('1.2.840.10008.1.2.4.50')))
+        self.assertTrue(_dicom_compressed(dicom('1.2.840.10008.1.2.4.90')))
+        self.assertFalse(_dicom_compressed('\x00' * 2000))
+        self.assertFalse(_dicom_compressed(dicom('1.2.840.10008.1.2.4.50')[:140]))
+        self.assertEqual(self.compress_type('image.dcm', dicom('1.2.840.10008.1.2.4.50')), ZIP_STORED)
+        self.assertEqual(self.compress_type('image.dcm', dicom('1.2.840.10008.1.2.1')), ZIP_DEFLATED)
+
+    def test_extensions_and_mime_types(self):
+        text = 'compressible text ' * 1000
+        self.assertEqual(self.compress_type('data.txt', text), ZIP_DEFLATED)
+        self.assertEqual(self.compress_type('DATA.GZ', text), ZIP_STORED)
+        self.assertEqual(self.compress_type('data', text, 'application/zip'), ZIP_STORED)
+        self.assertEqual(self.compress_type('data', text, 'image/png'), ZIP_STORED)
+        self.assertEqual(self.compress_type('data', text, 'image/tiff'), ZIP_DEFLATED)
+        self.assertEqual(self.compress_type('data', text, 'text/plain; charset=utf-8'), ZIP_DEFLATED)
+
+    def test_trial_compression(self):
+        self.assertEqual(self.compress_type('data.bin', os.urandom(100000)), ZIP_STORED)
+        self.assertEqual(self.compress_type('small.txt', 'x' * 100), ZIP_STORED)
+
+
+class ConcurrencyTest(SimpleTestCase):
+
+    def test_concurrency_at_least_one(self):
+        server = DarisServer(pk=1, max_connections=0)
+        self.assertEqual(_concurrency(server), 1)
+        self.assertEqual(_concurrency(server, 4), 1)
+        server.max_connections = 3
+        self.assertEqual(_concurrency(server), 3)
+        self.assertEqual(_concurrency(server, 2), 2)
+        self.assertEqual(_concurrency(server, 0), 1)
+
+    def test_server_semaphores(self):
+        server = DarisServer(pk=1, max_connections=0)
+        semaphores = _server_semaphores([DarisProject(pk=1, server=server), DarisProject(pk=2, server=server)])
+        self.assertEqual(list(semaphores), [1])
+        self.assertTrue(semaphores[1].acquire(False))
+        self.assertFalse(semaphores[1].acquire(False))
+
+
+class RunWorkersTest(SimpleTestCase):
+
+    def test_failures(self):
+        done = []
+
+        def work(daris, value):
+            if value % 3 == 0:
+                raise ValueError('value ' + str(value))
+            done.append(value)
+
+        items = [(str(value), 'value ' + str(value), value) for value in range(1, 8)]
+        with self.assertRaises(ExTransferFailed) as context:
+            _run_workers(None, items, work, 3, what='%d of %d values', label='value')
+        self.assertEqual(sorted(done), [1, 2, 4, 5, 7])
+        self.assertEqual(context.exception.errors, {'3': 'value 3', '6': 'value 6'})
+        self.assertEqual(str(context.exception), 'Failed to send 2 of 7 values: value 3 (value 3), value 6 (value 6)')
+
+    def test_slots(self):
+        # a budget of 3 connections, one of them held by the caller and one by another worker
+        slots = threading.BoundedSemaphore(3)
+        slots.acquire()
+        slots.acquire()
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work(daris, value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        _run_workers(None, [(str(value), str(value), value) for value in range(10)], work, 10, slots=slots, held=1)
+        self.assertLessEqual(running[1], 2)
+        # the slots taken by the workers are given back, the one of the caller is still held
+        self.assertTrue(slots.acquire(False))
+        self.assertFalse(slots.acquire(False))
+
+
+class UnicodeNameTest(SimpleTestCase):
+
+    def test_xml_string_writer(self):
+        w = XmlStringWriter('args')
+        w.add('path', u'déjà/vu.txt')
+        self.assertEqual(w.doc_text(), '<args><path>d\xc3\xa9j\xc3\xa0/vu.txt</path></args>')
+
+    def test_tarinfo(self):
+        tarinfo = _tarinfo(DataFile(u'déjà', u'vu.txt', 3, None))
+        header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, 'ascii', 'strict')
+        self.assertEqual(tarfile.TarInfo.frombuf(header[:tarfile.BLOCKSIZE]).name, 'd\xc3\xa9j\xc3\xa0/vu.txt')
+
+
+class FakeMediaflux(object):
+    """Mediaflux server on a local port. system.logon opens a new session, and the other services reply with the
+    same result, or with an invalid session error if their session has been invalidated. It keeps the bodies of the
+    requests. With close_after, it closes a socket kept alive without replying when the request after close_after
+    replies arrives, as when the keep-alive timeout of a server expires while a request is on its way."""
+
+    RESULT = '<response><reply type="result"><result><version>4.0</version></result></reply></response>'
+    LOGON = '<response><reply type="result"><result><session id="%d" timeout="600">%s</session></result></reply>' \
+            '</response>'
+    SESSION_INVALID = '<response><reply type="error"><error>arc.mf.server.Services$ExSessionInvalid</error>' \
+                      '<message>The session is not valid</message></reply></response>'
+
+    def __init__(self, close_after=0):
+        self.bodies = []
+        self.accepts = 0
+        self.sessions = []
+        self.invalid_sessions = set()
+        # content of the output of the services other than system.logon, if any
+        self.output = None
+        self._close_after = close_after
+        self._lsock = socket.socket()
+        self._lsock.bind(('127.0.0.1', 0))
+        self._lsock.listen(8)
+        self.port = self._lsock.getsockname()[1]
+        for _ in range(8):
+            thread = threading.Thread(target=self._serve)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        self._lsock.close()
+
+    def services(self):
+        return [re.search(r'<service [^>]*name="([^"]*)"', body).group(1) for body in self.bodies]
+
+    def _reply(self, body):
+        service = re.search(r'<service [^>]*name="([^"]*)"', body).group(1)
+        session = re.search(r'<service [^>]*session="([^"]*)"', body)
+        if service == 'system.logon':
+            self.sessions.append('session-' + str(len(self.sessions) + 1))
+            return self.LOGON % (len(self.sessions), self.sessions[-1])
+        if session is not None and session.group(1) in self.invalid_sessions:
+            return self.SESSION_INVALID
+        return self.RESULT
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._lsock.accept()
+            except socket.error:
+                return
+            self.accepts += 1
+            f = sock.makefile('rb')
+            try:
+                replies = 0
+                while True:
+                    header = f.readline()
+                    if not header or (self._close_after and replies == self._close_after):
+                        break
+                    length = 0
+                    while header not in ('\r\n', ''):
+                        if header.lower().startswith('content-length:'):
+                            length = int(header.split(':')[1])
+                        header = f.readline()
+                    body = f.read(length)
+                    self.bodies.append(body)
+                    reply = self._reply(body)
+                    output = self.output if 'system.logon' not in body else None
+                    content = '\x01\x00' + struct.pack('>qih', len(reply), 0 if output is None else 1, 8) + \
+                              'text/xml' + reply
+                    if output is not None:
+                        content += '\x01\x00' + struct.pack('>qih', len(output), 0, 0) + output
+                    sock.sendall('HTTP/1.1 200 OK\r\nContent-Type: application/mflux\r\nContent-Length: ' +
+                                 str(len(content)) + '\r\n\r\n' + content)
+                    replies += 1
+            finally:
+                f.close()
+                sock.close()
+
+
+class MFConnectionTest(SimpleTestCase):
+
+    def test_keep_alive(self):
+        server = FakeMediaflux()
+        try:
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            cxn.connect(token='token')
+            for _ in range(3):
+                self.assertEqual(cxn.execute('server.version').value('version'), '4.0')
+            cxn.close()
+            self.assertEqual(server.accepts, 1)
+        finally:
+            server.close()
+
+    def test_retry_after_server_closes(self):
+        server = FakeMediaflux(close_after=1)
+        try:
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            cxn.connect(token='token')
+            # the server closes the socket kept alive by the client: the call is sent again over a new socket
+            self.assertEqual(cxn.execute('server.version').value('version'), '4.0')
+            self.assertEqual(server.accepts, 2)
+            self.assertEqual(server.services(), ['system.logon', 'server.version'])
+        finally:
+            server.close()
+
+    def test_no_retry_with_inputs(self):
+        server = FakeMediaflux(close_after=1)
+        try:
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            cxn.connect(token='token')
+            # the reused socket has been closed by the server, but the inputs may have been consumed already
+            with self.assertRaises(Exception):
+                cxn.execute('asset.create', None, [mfclient.MFStreamInput(lambda fp: fp.write('x' * 10), None, 10)])
+            self.assertEqual(server.services(), ['system.logon'])
+            self.assertEqual(server.accepts, 1)
+        finally:
+            server.close()
+
+    def test_logon_again_when_session_invalid(self):
+        server = FakeMediaflux()
+        try:
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            cxn.connect(token='token')
+            server.invalid_sessions.add(cxn.session)
+            self.assertEqual(cxn.execute('server.version').value('version'), '4.0')
+            self.assertEqual(cxn.session, 'session-2')
+            self.assertEqual(server.services(), ['system.logon', 'server.version', 'system.logon', 'server.version'])
+            # the session invalidated again: the call fails once the new logon is rejected too
+            server.invalid_sessions.add(cxn.session)
+            cxn._token = None
+            self.assertRaises(mfclient.ExSessionInvalid, cxn.execute, 'server.version')
+        finally:
+            server.close()
+
+
+class ConnectionPoolTest(SimpleTestCase):
+
+    def test_reuse(self):
+        server = FakeMediaflux()
+        try:
+            daris_project = DarisProject(pk=1, token='token', server=DarisServer(
+                pk=1, host='127.0.0.1', port=server.port, transport='http', max_connections=1))
+            pool = _ConnectionPool(2, 60)
+            cxn = pool.acquire(daris_project)
+            cxn.execute('server.version')
+            pool.release(cxn)
+            self.assertIs(pool.acquire(daris_project), cxn)
+            cxn.execute('server.version')
+            self.assertEqual(server.services(), ['system.logon', 'server.version', 'server.version'])
+            self.assertEqual(server.accepts, 1)
+            # a connection logged off is not kept
+            cxn.disconnect()
+            pool.release(cxn)
+            self.assertIsNot(pool.acquire(daris_project), cxn)
+        finally:
+            server.close()
+
+
+class ExecuteAllTest(SimpleTestCase):
+
+    def test_requires_trollius(self):
+        asyncio = mfclient.asyncio
+        mfclient.asyncio = None
+        try:
+            self.assertRaises(RuntimeError, mfclient.execute_all, mfclient.MFConnection('127.0.0.1', 1, False), [])
+        finally:
+            mfclient.asyncio = asyncio
+
+    @skipIf(mfclient.asyncio is None, 'requires the trollius package')
+    def test_execute_all(self):
+        server = FakeMediaflux()
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'input.bin')
+            data = os.urandom(100000)
+            with open(path, 'wb') as f:
+                f.write(data)
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            calls = [('server.version',)] * 5 + [('asset.create', None, [mfclient.MFInput(path)])]
+            results = mfclient.execute_all(cxn, calls, max_streams=2)
+            self.assertEqual([result.value('version') for result in results], ['4.0'] * 6)
+            self.assertEqual(len(server.bodies), 6)
+            self.assertEqual(len([body for body in server.bodies if body.endswith(data)]), 1)
+        finally:
+            server.close()
+            shutil.rmtree(directory)
+
+    @skipIf(mfclient.asyncio is None, 'requires the trollius package')
+    def test_outputs(self):
+        server = FakeMediaflux()
+        server.output = os.urandom(300000)
+        directory = tempfile.mkdtemp()
+        try:
+            cxn = mfclient.MFConnection('127.0.0.1', server.port, False)
+            paths = [os.path.join(directory, 'output' + str(i)) for i in range(3)]
+            calls = [('asset.get', None, None, mfclient.MFOutput(path)) for path in paths]
+            results = mfclient.execute_all(cxn, calls, max_streams=2)
+            self.assertEqual([result.value('version') for result in results], ['4.0'] * 3)
+            for path in paths:
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), server.output)
+        finally:
+            server.close()
+            shutil.rmtree(directory)
+
+    @skipIf(mfclient.asyncio is None, 'requires the trollius package')
+    def test_idle_streams_expire(self):
+
+        class Stream(object):
+            closed = False
+
+            def at_eof(self):
+                return False
+
+            def close(self):
+                self.closed = True
+
+        loop = mfclient.asyncio.new_event_loop()
+        try:
+            acxn = mfclient.AsyncMFConnection.from_connection(
+                mfclient.MFConnection('127.0.0.1', 1, False, idle_timeout=60), loop=loop)
+            now = time.time()
+            streams = [Stream() for _ in range(4)]
+            acxn._idle = [(stream, stream, idle_since) for stream, idle_since in
+                          zip(streams, [now - 300, now - 120, now - 10, now - 1])]
+            # the most recently used stream is reused, the expired ones are closed
+            self.assertEqual(acxn._reusable_stream(), (streams[3], streams[3]))
+            self.assertEqual([stream.closed for stream in streams], [True, True, False, False])
+            self.assertEqual(len(acxn._idle), 1)
+        finally:
+            loop.close()
+
+
+class SplitSocket(object):
+    """Socket whose recv_into() returns at most chunk_size bytes at a time."""
+
+    def __init__(self, data, chunk_size):
+        self._data = data
+        self._position = 0
+        self._chunk_size = chunk_size
+
+    def recv_into(self, buf):
+        size = min(len(buf), self._chunk_size, len(self._data) - self._position)
+        buf[:size] = self._data[self._position:self._position + size]
+        self._position += size
+        return size
+
+
+class MFResponseTest(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def response(xml, output=None):
+        content = '\x01\x00' + struct.pack('>qih', len(xml), 1 if output is not None else 0, 8) + 'text/xml' + xml
+        if output is not None:
+            content += '\x01\x00' + struct.pack('>qih', len(output), 0, 3) + 'a/b' + output
+        return ('HTTP/1.1 200 OK\r\nContent-Type: application/mflux\r\nContent-Length: ' + str(len(content)) +
+                '\r\n\r\n' + content)
+
+    def test_split_reads(self):
+        xml = '<response><reply type="result"><result><id>1</id></result></reply></response>'
+        output = os.urandom(200000)
+        path = os.path.join(self.directory, 'output')
+        for chunk_size in (3, 1000, 1 << 20):
+            response = mfclient.MFResponse(mfclient.MFOutput(path))
+            response.recv(SplitSocket(self.response(xml, output), chunk_size))
+            self.assertEqual(response.result.value('id'), '1')
+            self.assertTrue(response.keep_alive)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), output)
+
+    def test_large_result(self):
+        # larger than the initial receive buffer, which grows to hold it
+        xml = '<response><reply type="result"><result>' + '<id>1</id>' * 20000 + '</result></reply></response>'
+        for chunk_size in (7, 5000):
+            response = mfclient.MFResponse(None)
+            response.recv(SplitSocket(self.response(xml), chunk_size))
+            self.assertEqual(len(response.result.values('id')), 20000)
+
+    def test_incomplete_packet(self):
+        data = self.response('<response><reply type="result"><result/></reply></response>')
+        response = mfclient.MFResponse(None)
+        self.assertRaises(mfclient.ExHttpResponse, response.recv, SplitSocket(data[:-10], 5))
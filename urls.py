@@ -7,6 +7,8 @@ urlpatterns = [url(r'^experiment/(?P<experiment_id>\d+)/$', views.send_experimen
                url(r'^dataset/(?P<dataset_id>\d+)/$', views.send_dataset, name='send-dataset'),
                url(r'^dataset/(?P<dataset_id>\d+)/to/project/(?P<daris_project_id>\d+)/$',
                    views.send_dataset, name='send-dataset-to-daris'),
+               url(r'^dataset/(?P<dataset_id>\d+)/to/projects/$', views.send_dataset_to_projects,
+                   name='send-dataset-to-daris-projects'),
                url(r'^datafile/(?P<datafile_id>\d+)/$', views.send_datafile, name='send-datafile'),
                url(r'^datafile/(?P<datafile_id>\d+)/to/project/(?P<daris_project_id>\d+)/$',
                    views.send_datafile, name='send-datafile-to-daris'),
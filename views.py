@@ -8,6 +8,7 @@ from tardis.tardis_portal.models import Experiment, Dataset, DataFile
 from .models import DarisProject
 from . import tasks
 from celery.result import AsyncResult
+from celery.result import GroupResult
 import json
 
 
@@ -23,15 +24,42 @@ def send_dataset(request, dataset_id, daris_project_id=None):
     return _send_to_daris(request, 'dataset', dataset_id, daris_project_id)
 
 
+@login_required
+@authz.dataset_download_required
+def send_dataset_to_projects(request, dataset_id):
+    """Sends the dataset to the DaRIS projects listed by the project query parameters, in one task."""
+    daris_project_ids = []
+    for daris_project_id in request.GET.getlist('project'):
+        if daris_project_id not in daris_project_ids:
+            daris_project_ids.append(daris_project_id)
+    if not daris_project_ids:
+        return _send_to_daris(request, 'dataset', dataset_id)
+    daris_projects = [DarisProject.objects.get(pk=daris_project_id) for daris_project_id in daris_project_ids]
+    result = tasks.send_dataset_to_projects.delay(dataset_id, [daris_project.pk for daris_project in daris_projects],
+                                                  _host_addr(request))
+    template = loader.get_template('send-to-daris/task-monitor.html')
+    context = {
+        'url_prefix': reverse(send_dataset, kwargs={'dataset_id': dataset_id}),
+        'object_type': 'dataset',
+        'object': Dataset.objects.get(pk=dataset_id),
+        'daris_projects': daris_projects,
+        'task_id': result.id,
+    }
+    return HttpResponse(template.render(context, request))
+
+
 @login_required
 @authz.datafile_access_required
 def send_datafile(request, datafile_id, daris_project_id=None):
     return _send_to_daris(request, 'datafile', datafile_id, daris_project_id)
 
 
+def _host_addr(request):
+    return ('https://' if request.is_secure() else 'http://') + request.get_host()
+
+
 def _send_to_daris(request, object_type, object_id, daris_project_id=None):
-    host_addr = 'https://' if request.is_secure() else 'http://'
-    host_addr += request.get_host()
+    host_addr = _host_addr(request)
     if daris_project_id:
         template = loader.get_template('send-to-daris/task-monitor.html')
         daris_project = DarisProject.objects.get(pk=daris_project_id)
@@ -68,5 +96,33 @@ def _send_to_daris(request, object_type, object_id, daris_project_id=None):
 def task_status(request):
     task_id = request.GET['task_id']
     task = AsyncResult(task_id)
-    return HttpResponse(json.dumps({'state': task.state, 'info': task.result if task.result else None}),
+    state = task.state
+    info = task.result if task.result else None
+    if isinstance(info, Exception):
+        info = {'current_activity': str(info)}
+    elif state == 'SUCCESS' and isinstance(info, dict) and 'group_id' in info:
+        state, info = _group_status(info['group_id'], info['datasets'])
+    return HttpResponse(json.dumps({'state': state, 'info': info}),
                         content_type='application/json')
+
+
+def _group_status(group_id, dataset_ids):
+    """Rolls up the states of the dataset tasks dispatched by an experiment task."""
+    group_result = GroupResult.restore(group_id)
+    if group_result is None:
+        return 'FAILURE', {'current_activity': 'Unknown dataset task group: ' + group_id}
+    total = len(group_result.results)
+    completed = 0
+    failed = {}
+    for dataset_id, result in zip(dataset_ids, group_result.results):
+        if result.state == 'SUCCESS':
+            completed += 1
+        elif result.state == 'FAILURE':
+            completed += 1
+            failed[str(dataset_id)] = str(result.result)
+    info = {'current_activity': 'sent ' + str(completed - len(failed)) + ' of ' + str(total) + ' datasets',
+            'progress': str(completed) + '/' + str(total),
+            'failed': failed}
+    if completed < total:
+        return 'STARTED', info
+    return ('FAILURE' if failed else 'SUCCESS'), info
@@ -1,11 +1,24 @@
+import io
 import os
+import sys
+import stat
 import time
+import struct
 import binascii
+import collections
+from array import array
+from multiprocessing.pool import ThreadPool
 from zipfile import ZipFile
 from zipfile import ZipInfo
 from zipfile import ZIP_STORED
 from zipfile import ZIP_DEFLATED
 from zipfile import ZIP64_LIMIT
+from zipfile import ZIP_FILECOUNT_LIMIT
+from zipfile import sizeFileHeader
+from zipfile import sizeCentralDir
+from zipfile import sizeEndCentDir
+from zipfile import sizeEndCentDir64
+from zipfile import sizeEndCentDir64Locator
 
 try:
     import zlib  # We may need its compression method
@@ -16,35 +29,369 @@ except ImportError:
     crc32 = binascii.crc32
 
 
+_DATA_DESCRIPTOR_SIGNATURE = 'PK\x07\x08'
+
+# default size of the blocks read from file objects
+DEFAULT_BLOCK_SIZE = 256 * 1024
+# maximum size of the blocks read from file objects when tuned to the storage
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+# size of the blocks compressed in parallel
+DEFLATE_BLOCK_SIZE = 128 * 1024
+# final, empty deflate block ending the stream of the blocks compressed in parallel
+_DEFLATE_END = '\x03\x00'
+
+
+def _fileno(file_object):
+    """Returns the file descriptor of the file object if it is backed by a regular file, otherwise None."""
+    try:
+        fd = file_object.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _normalize_arcname(arcname):
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+def _gf2_matrix_compose(a, b):
+    """Returns the operator applying b, then a."""
+    return [_gf2_matrix_times(a, b[n]) for n in range(32)]
+
+
+# operator for one zero byte: the operator for one zero bit, squared three times
+_CRC32_ZERO_BYTE = [0xedb88320] + [1 << n for n in range(31)]
+for _ in range(3):
+    _CRC32_ZERO_BYTE = _gf2_matrix_square(_CRC32_ZERO_BYTE)
+# operators for 2**n zero bytes, for all the 64-bit lengths, built once so that the threads only read them
+_CRC32_POWERS = [_CRC32_ZERO_BYTE]
+while len(_CRC32_POWERS) < 64:
+    _CRC32_POWERS.append(_gf2_matrix_square(_CRC32_POWERS[-1]))
+
+
+def _crc32_operator(length):
+    """Returns the operator updating a CRC32 with length zero bytes, without the pre and post conditioning (see
+    crc32_combine() in zlib). It is composed from the powers of two, like crc32_combine()."""
+    operator = None
+    n = 0
+    while length:
+        if length & 1:
+            operator = _CRC32_POWERS[n] if operator is None else _gf2_matrix_compose(_CRC32_POWERS[n], operator)
+        length >>= 1
+        n += 1
+    return operator
+
+
+# operator for the blocks compressed in parallel, all of this length but the last one of each entry
+_CRC32_BLOCK_OPERATOR = _crc32_operator(DEFLATE_BLOCK_SIZE)
+
+
+class _Crc32Combiner(object):
+    """Combines the CRC32 of consecutive blocks into the CRC32 of their concatenation. The operator for
+    DEFLATE_BLOCK_SIZE is built at import, so only the last block of each entry needs a new one."""
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, crc, length):
+        if length == 0:
+            return self.crc
+        operator = _CRC32_BLOCK_OPERATOR if length == DEFLATE_BLOCK_SIZE else _crc32_operator(length)
+        self.crc = _gf2_matrix_times(operator, self.crc) ^ crc
+        return self.crc
+
+
+def _deflate_block(block, compute_crc):
+    """Compresses the block into a byte aligned sequence of deflate blocks, none of them final, so that the
+    outputs of consecutive blocks can be concatenated. zlib releases the GIL while compressing."""
+    cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    data = cmpr.compress(block) + cmpr.flush(zlib.Z_SYNC_FLUSH)
+    return data, (crc32(block) & 0xffffffff) if compute_crc else 0
+
+
+def _tuned_block_size(file_object):
+    """Returns the size of the blocks to read the file object with: the preferred I/O size of the underlying
+    storage (e.g. the rsize of a NFS mount) if it is larger than the default, otherwise the default."""
+    try:
+        blksize = os.fstat(file_object.fileno()).st_blksize
+    except (AttributeError, IOError, OSError, ValueError):
+        return DEFAULT_BLOCK_SIZE
+    return min(max(blksize, DEFAULT_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def stored_archive_length(entries, data_descriptor=False, allowZip64=True):
+    """Returns the exact length of the ZIP_STORED archive that WZipFile.writeobj creates from the entries,
+    without reading any data. Each entry is an (arcname, file_length, crc) tuple, where crc is None if it is not
+    known in advance. data_descriptor tells whether the archive is written in data descriptor mode (see
+    WZipFile)."""
+    offset = 0L
+    count = 0
+    central_dir_size = 0L
+    for arcname, file_length, crc in entries:
+        filename, _ = ZipInfo(_normalize_arcname(arcname))._encodeFilenameFlags()
+        zip64 = allowZip64 and file_length * 1.05 > ZIP64_LIMIT
+        header_offset = offset
+        # local file header, zip64 extra field and data
+        offset += sizeFileHeader + len(filename) + (20 if zip64 else 0) + file_length
+        if crc is None and data_descriptor:
+            # data descriptor
+            offset += 24 if zip64 else 16
+        # central directory record, with zip64 extra field for the sizes and the header offset if needed
+        nb_zip64_values = (2 if file_length > ZIP64_LIMIT else 0) + (1 if header_offset > ZIP64_LIMIT else 0)
+        central_dir_size += sizeCentralDir + len(filename) + (4 + 8 * nb_zip64_values if nb_zip64_values else 0)
+        count += 1
+    length = offset + central_dir_size
+    if count > ZIP_FILECOUNT_LIMIT or offset > ZIP64_LIMIT or central_dir_size > ZIP64_LIMIT:
+        length += sizeEndCentDir64 + sizeEndCentDir64Locator
+    return length + sizeEndCentDir
+
+
+def _seekable(fp):
+    if not hasattr(fp, 'seek') or not hasattr(fp, 'tell'):
+        return False
+    try:
+        fp.tell()
+    except (IOError, OSError):
+        return False
+    return True
+
+
+class _Tellable(object):
+    """Wraps a write-only stream (socket, pipe or http request body) and keeps track of the position so that
+    it can be used as the output of ZipFile.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0L
+        # sockets have sendall() rather than write()
+        self._write = fp.write if hasattr(fp, 'write') else fp.sendall
+
+    def write(self, data):
+        self._write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        if hasattr(self.fp, 'flush'):
+            self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+# array type code for offsets and sizes: Python 2 has no 'Q', and 'L' has 32 bits on some platforms, where
+# doubles hold the values exactly up to 2**53
+_OFFSET_TYPECODE = 'L' if array('L').itemsize >= 8 else 'd'
+
+
+class _CentralDirectory(object):
+    """Compact replacement of ZipFile.filelist for archives being written. The fields of the entries are packed
+    into arrays, about 50 bytes per entry plus the name, instead of keeping a ZipInfo object (about a kilobyte)
+    per entry until the archive is closed. The ZipInfo objects are rebuilt on iteration, so ZipFile.close()
+    writes the same central directory as with a list.
+    """
+
+    # ZipInfo attributes which are kept only if they differ from the default
+    _RARE_ATTRIBUTES = ('create_system', 'reserved', 'internal_attr', 'extra', 'comment')
+
+    def __init__(self):
+        self._names = bytearray()
+        self._name_ends = array(_OFFSET_TYPECODE)
+        self._header_offsets = array(_OFFSET_TYPECODE)
+        self._file_sizes = array(_OFFSET_TYPECODE)
+        self._compress_sizes = array(_OFFSET_TYPECODE)
+        self._crcs = array('I')
+        self._date_times = array('I')
+        self._flag_bits = array('H')
+        self._compress_types = array('H')
+        self._external_attrs = array('I')
+        self._versions = array('H')
+        self._rare = {}
+        self._default = ZipInfo()
+
+    def append(self, zinfo):
+        filename = zinfo.filename
+        rare = dict((name, getattr(zinfo, name)) for name in self._RARE_ATTRIBUTES
+                    if getattr(zinfo, name) != getattr(self._default, name))
+        if isinstance(filename, unicode):
+            rare['unicode'] = True
+            filename = filename.encode('utf-8')
+        dt = zinfo.date_time
+        values = (zinfo.header_offset, zinfo.file_size, zinfo.compress_size, zinfo.CRC,
+                  (dt[0] - 1980) << 25 | dt[1] << 21 | dt[2] << 16 | dt[3] << 11 | dt[4] << 5 | (dt[5] // 2),
+                  zinfo.flag_bits, zinfo.compress_type, zinfo.external_attr,
+                  zinfo.extract_version << 8 | zinfo.create_version)
+        if rare:
+            self._rare[len(self)] = rare
+        self._names += filename
+        self._name_ends.append(len(self._names))
+        for values_array, value in zip((self._header_offsets, self._file_sizes, self._compress_sizes, self._crcs,
+                                        self._date_times, self._flag_bits, self._compress_types,
+                                        self._external_attrs, self._versions), values):
+            values_array.append(value)
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('central directory index out of range')
+        filename = str(self._names[int(self._name_ends[index - 1]) if index else 0:int(self._name_ends[index])])
+        rare = self._rare.get(index, {})
+        if rare.get('unicode'):
+            filename = filename.decode('utf-8')
+        t = self._date_times[index]
+        zinfo = ZipInfo(filename, ((t >> 25) + 1980, t >> 21 & 0xf, t >> 16 & 0x1f, t >> 11 & 0x1f, t >> 5 & 0x3f,
+                                   (t & 0x1f) * 2))
+        zinfo.header_offset = long(self._header_offsets[index])
+        zinfo.file_size = long(self._file_sizes[index])
+        zinfo.compress_size = long(self._compress_sizes[index])
+        zinfo.CRC = self._crcs[index]
+        zinfo.flag_bits = self._flag_bits[index]
+        zinfo.compress_type = self._compress_types[index]
+        zinfo.external_attr = self._external_attrs[index]
+        zinfo.extract_version = self._versions[index] >> 8
+        zinfo.create_version = self._versions[index] & 0xff
+        for name, value in rare.items():
+            if name != 'unicode':
+                setattr(zinfo, name, value)
+        return zinfo
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+
+class _NoNames(dict):
+    """Replacement of ZipFile.NameToInfo for archives being written which does not keep the entries. Duplicate
+    names are therefore not reported."""
+
+    def __setitem__(self, key, value):
+        pass
+
+
 class WZipFile(ZipFile):
-    def writeobj(self, file_object, file_length, arcname, compress_type=None, date_time=None):
+    """ZipFile which can also write entries from file objects, and write archives to non-seekable streams.
+
+    In data descriptor mode, the entries are written with general purpose flag bit 3 set: the CRC and sizes
+    follow the data of each entry in a data descriptor, so the archive is written strictly sequentially with
+    constant memory and without seeking back. data_descriptor defaults to True for non-seekable file objects
+    (sockets, pipes, http request bodies), which can only be written in this mode, and to False otherwise.
+
+    writeobj() reads the file objects into one reusable buffer of block_size bytes, tuned to the storage of each
+    file object if block_size is None. The output must therefore not keep references to the data written to it.
+
+    With deflate_threads > 1, ZIP_DEFLATED entries are compressed in parallel, like pigz: the data is split in
+    blocks compressed independently on a thread pool, and the outputs are stitched into one deflate stream.
+
+    In mode "w", the entries are kept in a compact _CentralDirectory until the archive is closed, so the memory
+    used grows by tens of bytes per entry. getinfo() is not available in this mode, and duplicate names are not
+    reported.
+    """
+
+    def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False, data_descriptor=None,
+                 block_size=None, deflate_threads=1):
+        seekable = isinstance(file, basestring) or _seekable(file)
+        if not seekable:
+            if mode != 'w':
+                raise RuntimeError('Cannot read or append non-seekable file object.')
+            if data_descriptor is False:
+                raise RuntimeError('Non-seekable file object can only be written in data descriptor mode.')
+            file = _Tellable(file)
+        self._data_descriptor = not seekable if data_descriptor is None else data_descriptor
+        self._block_size = block_size
+        self._buffer = None
+        self._deflate_threads = deflate_threads
+        self._pool = None
+        super(WZipFile, self).__init__(file, mode, compression, allowZip64)
+        if self.mode == 'w':
+            self.filelist = _CentralDirectory()
+            self.NameToInfo = _NoNames()
+
+    @property
+    def data_descriptor(self):
+        return self._data_descriptor
+
+    def write(self, filename, arcname=None, compress_type=None):
+        """Put the bytes from filename into the archive under the name
+        arcname. In data descriptor mode, the bytes are written by
+        writeobj() instead of ZipFile.write(), which seeks back."""
+        st = os.stat(filename)
+        if not self._data_descriptor or stat.S_ISDIR(st.st_mode):
+            return super(WZipFile, self).write(filename, arcname, compress_type)
+        with open(filename, 'rb') as f:
+            return self.writeobj(f, st.st_size, filename if arcname is None else arcname,
+                                 compress_type=compress_type, date_time=time.localtime(st.st_mtime)[0:6],
+                                 external_attr=(st[0] & 0xFFFF) << 16L)  # Unix attributes
+
+    def writeobj(self, file_object, file_length, arcname, compress_type=None, date_time=None, crc=None,
+                 external_attr=0o600 << 16):
         """Put the bytes from file_object into the archive under the name
-                arcname."""
+                arcname. If the CRC32 of the bytes is known, it is not computed
+                again and, unless the bytes are compressed, the final file header
+                is written in one pass. external_attr holds the Unix attributes
+                of the entry in its high 16 bits. Returns the ZipInfo of the
+                entry, which must not be modified since it has been stored."""
         if not self.fp:
             raise RuntimeError(
                 "Attempt to write to ZIP archive that was already closed")
 
-        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
-        while arcname[0] in (os.sep, os.altsep):
-            arcname = arcname[1:]
+        arcname = _normalize_arcname(arcname)
         date_time = date_time if date_time else time.localtime(time.time())[:6]
         zinfo = ZipInfo(arcname, date_time)
-        zinfo.external_attr = zinfo.external_attr = 0o600 << 16  # Unix attributes
+        zinfo.external_attr = external_attr
         zinfo.compress_type = compress_type if compress_type else self.compression
 
         zinfo.file_size = file_length
-        zinfo.flag_bits = 0x00
+        # With known CRC and sizes, the file header does not need to be overwritten later
+        final_header = crc is not None and zinfo.compress_type == ZIP_STORED
+        # Data descriptor mode: CRC and sizes follow the file data
+        zinfo.flag_bits = 0x08 if self._data_descriptor and not final_header else 0x00
         zinfo.header_offset = self.fp.tell()  # Start of header bytes
 
         self._writecheck(zinfo)
         self._didModify = True
 
-        # Must overwrite CRC and sizes with correct data later
-        zinfo.CRC = crc = 0
-        zinfo.compress_size = compress_size = 0
+        if final_header:
+            zinfo.CRC = crc
+            zinfo.compress_size = file_length
+        else:
+            # Must overwrite CRC and sizes with correct data later
+            zinfo.CRC = 0
+            zinfo.compress_size = 0
+        compress_size = 0
+        crc_computed = 0
         # Compressed size can be larger than uncompressed size
         zip64 = self._allowZip64 and \
                 zinfo.file_size * 1.05 > ZIP64_LIMIT
+        if zip64:
+            zinfo.extract_version = max(45, zinfo.extract_version)
+            zinfo.create_version = max(45, zinfo.extract_version)
         self.fp.write(zinfo.FileHeader(zip64))
         if zinfo.compress_type == ZIP_DEFLATED:
             cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
@@ -52,52 +399,118 @@ class WZipFile(ZipFile):
         else:
             cmpr = None
         file_size = 0
-        while 1:
-            buf = file_object.read(1024 * 8)
-            if not buf:
-                break
-            file_size += len(buf)
-            crc = crc32(buf, crc) & 0xffffffff
-            if cmpr:
-                buf = cmpr.compress(buf)
-                compress_size += len(buf)
-            self.fp.write(buf)
+        fd = _fileno(file_object) if cmpr is None else None
+        if fd is not None:
+            # stored files with a real file descriptor are read without the buffering of the file object,
+            # straight into the reusable buffer
+            os.lseek(fd, file_object.tell(), os.SEEK_SET)
+            file_object = io.FileIO(fd, 'rb', closefd=False)
+        if cmpr and self._deflate_threads > 1:
+            file_size, compress_size, crc_computed = self._deflate_parallel(file_object, crc is None)
+            cmpr = None
+            zinfo.compress_size = compress_size
+        else:
+            block_size = self._block_size or _tuned_block_size(file_object)
+            if self._buffer is None or len(self._buffer) != block_size:
+                self._buffer = bytearray(block_size)
+            readinto = getattr(file_object, 'readinto', None)
+            while 1:
+                if readinto is not None:
+                    n = readinto(self._buffer)
+                    buf = buffer(self._buffer, 0, n or 0)
+                else:
+                    buf = file_object.read(block_size)
+                if not buf:
+                    break
+                file_size += len(buf)
+                if crc is None:
+                    crc_computed = crc32(buf, crc_computed) & 0xffffffff
+                if cmpr:
+                    buf = cmpr.compress(buf)
+                    compress_size += len(buf)
+                self.fp.write(buf)
         if cmpr:
             buf = cmpr.flush()
             compress_size += len(buf)
             self.fp.write(buf)
             zinfo.compress_size = compress_size
-        else:
+        elif zinfo.compress_type == ZIP_STORED:
             zinfo.compress_size = file_size
-        zinfo.CRC = crc
+        zinfo.CRC = crc_computed if crc is None else crc
         zinfo.file_size = file_size
         if not zip64 and self._allowZip64:
             if file_size > ZIP64_LIMIT:
                 raise RuntimeError('File size has increased during compressing')
             if compress_size > ZIP64_LIMIT:
                 raise RuntimeError('Compressed size larger than uncompressed size')
-        # Seek backwards and write file header (which will now include
-        # correct CRC and file sizes)
-        position = self.fp.tell()  # Preserve current position in file
-        self.fp.seek(zinfo.header_offset, 0)
-        self.fp.write(zinfo.FileHeader(zip64))
-        self.fp.seek(position, 0)
+        if final_header:
+            if file_size != file_length:
+                raise RuntimeError('File size has changed during writing')
+        elif zinfo.flag_bits & 0x08:
+            # Write CRC and file sizes after the file data
+            fmt = '<4sLQQ' if zip64 else '<4sLLL'
+            self.fp.write(struct.pack(fmt, _DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, zinfo.compress_size,
+                                      zinfo.file_size))
+        else:
+            # Seek backwards and write file header (which will now include
+            # correct CRC and file sizes)
+            position = self.fp.tell()  # Preserve current position in file
+            self.fp.seek(zinfo.header_offset, 0)
+            self.fp.write(zinfo.FileHeader(zip64))
+            self.fp.seek(position, 0)
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
+        return zinfo
+
+    def _deflate_parallel(self, file_object, compute_crc):
+        """Compresses the file object on the thread pool, keeping at most two blocks per thread in flight.
+        Returns the uncompressed size, the compressed size and the CRC32 (0 if not computed)."""
+        if self._pool is None:
+            self._pool = ThreadPool(self._deflate_threads)
+        combiner = _Crc32Combiner()
+        pending = collections.deque()
+        file_size = 0
+        compress_size = 0
+        eof = False
+        while pending or not eof:
+            while not eof and len(pending) < 2 * self._deflate_threads:
+                block = file_object.read(DEFLATE_BLOCK_SIZE)
+                if not block:
+                    eof = True
+                    break
+                pending.append((len(block), self._pool.apply_async(_deflate_block, (block, compute_crc))))
+            if pending:
+                length, result = pending.popleft()
+                data, block_crc = result.get()
+                file_size += length
+                if compute_crc:
+                    combiner.update(block_crc, length)
+                compress_size += len(data)
+                self.fp.write(data)
+        self.fp.write(_DEFLATE_END)
+        compress_size += len(_DEFLATE_END)
+        return file_size, compress_size, combiner.crc
+
+    def close(self):
+        try:
+            super(WZipFile, self).close()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
 
 
 if __name__ == '__main__':
-    zipfile = WZipFile('/tmp/test1.zip', 'w', ZIP_STORED, allowZip64=True)
+    # usage: python wzipfile.py <archive.zip | -> <file>...
+    # With '-', the archive is written to stdout in data descriptor mode, e.g. to a pipe.
+    if len(sys.argv) < 3:
+        sys.stderr.write('usage: python wzipfile.py <archive.zip | -> <file>...\n')
+        sys.exit(1)
+    output = sys.stdout if sys.argv[1] == '-' else sys.argv[1]
+    zipfile = WZipFile(output, 'w', ZIP_STORED, allowZip64=True)
     try:
-        with open('/tmp/123.log', 'rb') as f:
-            st = os.stat('/tmp/123.log')
-            file_length = st.st_size
-            date_time = time.localtime(st.st_mtime)[0:6]
-            zipfile.writeobj(f, file_length, 'abc/123.log', date_time=date_time)
-        with open('/tmp/adb.log', 'rb') as f:
-            st = os.stat('/tmp/adb.log')
-            file_length = st.st_size
-            date_time = time.localtime(st.st_mtime)[0:6]
-            zipfile.writeobj(f, file_length, 'abc/adb.log', date_time=date_time)
+        for path in sys.argv[2:]:
+            zipfile.write(path)
     finally:
         zipfile.close()